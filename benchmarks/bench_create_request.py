@@ -0,0 +1,78 @@
+"""Замер скорости создания заявок на локальном PostgreSQL.
+
+Сравниваются три способа записи:
+- legacy  - INSERT и отдельный SELECT lastval() (два обращения к БД)
+- single  - create_request с RETURNING (одно обращение)
+- batched - request_batcher, объединяющий одновременные заявки в один INSERT
+
+Запуск из корня репозитория (DB_CONFIG и BOT_TOKEN берутся из bot.py):
+    python benchmarks/bench_create_request.py --requests 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+BENCH_USER_ID = -1  # Telegram не выдает отрицательных user_id, строки легко найти и удалить
+
+
+async def legacy_create_request(user_id: int, request_text: str, service_option_id: int = None):
+    """Создание заявки так, как это делалось до перехода на RETURNING"""
+    async with bot.db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO requests (user_id, request_text, service_option_id)
+            VALUES ($1, $2, $3)
+        ''', user_id, request_text, service_option_id)
+        return await conn.fetchval("SELECT lastval()")
+
+
+async def run(name: str, create, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            return await create(BENCH_USER_ID, f"benchmark request {i}")
+
+    started = time.perf_counter()
+    request_ids = await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    assert len(set(request_ids)) == total, "номера заявок должны быть уникальными"
+    print(f"{name:<8} {total / elapsed:>10.0f} заявок/с  ({elapsed:.2f} с)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    await bot.init_db()
+    bot.db_pool = await bot.create_db_pool()
+    try:
+        async with bot.db_pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO users (user_id, username, full_name)
+                VALUES ($1, 'benchmark', 'Benchmark')
+                ON CONFLICT (user_id) DO NOTHING
+            ''', BENCH_USER_ID)
+
+        await run("legacy", legacy_create_request, args.requests, args.concurrency)
+        await run("single", bot.create_request, args.requests, args.concurrency)
+        await run("batched", bot.request_batcher.submit, args.requests, args.concurrency)
+        await bot.request_batcher.stop()
+    finally:
+        async with bot.db_pool.acquire() as conn:
+            # Заявки удаляются явно: каскадное удаление не обновляет счетчики /stats
+            await conn.execute("DELETE FROM requests WHERE user_id = $1", BENCH_USER_ID)
+            await conn.execute("DELETE FROM users WHERE user_id = $1", BENCH_USER_ID)
+        await bot.db_pool.close()
+        await bot.bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,210 @@
+"""Нагрузочный прогон диспетчера без Telegram.
+
+Сгенерированные Update подаются напрямую в dp.feed_update, а вызовы Bot API
+обрабатывает заглушка сессии, поэтому замеряется только работа бота:
+middleware, маршрутизация, клавиатуры и запросы к локальному PostgreSQL.
+
+Сценарии:
+- start   - поток /start от разных пользователей
+- menu    - нажатия кнопок меню и выбор услуги
+- faq     - вопросы из FAQ
+- option  - выбор варианта услуги
+- request - свободный текст, который превращается в заявку
+
+Для каждого сценария выводятся обновления в секунду, задержки p50/p95/p99,
+а также число запросов к БД, захватов соединения из пула и вызовов Bot API
+на одно обновление; следующей строкой - самые частые запросы по именам.
+
+Стоимость логирования сравнивается прогонами с --log-level INFO и разными
+--log-pipeline: sync - запись прямо в обработчике, queue - через очередь
+и фоновый поток (как в боте). Журнал пишется в --log-output.
+
+Запуск из корня репозитория (DB_CONFIG и BOT_TOKEN берутся из bot.py):
+    python benchmarks/bench_dispatcher.py --updates 5000 --concurrency 100
+    python benchmarks/bench_dispatcher.py --scenarios start request
+    python benchmarks/bench_dispatcher.py --log-level INFO --log-pipeline sync
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram import Bot, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import SendPhoto  # noqa: E402
+
+import bot as botmod  # noqa: E402
+
+# Диапазон user_id для синтетических пользователей; после прогона они удаляются вместе с заявками
+BENCH_USER_BASE = 10 ** 12
+SCENARIOS = ("start", "menu", "faq", "option", "request")
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API, которая отвечает сразу и только считает вызовы"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if method.__returning__ is not types.Message:
+            return True
+        chat_id = getattr(method, "chat_id", 0)
+        photo = None
+        if isinstance(method, SendPhoto):
+            photo = [types.PhotoSize(file_id="bench-file-id", file_unique_id="bench", width=1, height=1)]
+        return types.Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=types.Chat(id=chat_id, type="private"),
+            photo=photo,
+        )
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def make_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=types.User(id=user_id, is_bot=False, first_name="Bench"),
+            text=text,
+        ),
+    )
+
+
+def scenario_texts(name: str) -> list:
+    catalog = botmod.catalog
+    if name == "start":
+        return ["/start"]
+    if name == "menu":
+        return [*botmod.STATIC_ROUTES, *catalog.services]
+    if name == "faq":
+        return list(catalog.faq)
+    if name == "option":
+        return list(catalog.options)
+    return [f"Нужен сайт для проекта, бюджет {i} 000₽" for i in range(10)]
+
+
+def query_counts() -> dict:
+    """Число выполненных запросов по именам.
+
+    Запросы реестра (conn.statements) замеряет TimedStatement, остальные -
+    логгер запросов asyncpg под именем "other".
+    """
+    return {labels[0]: series[-1] for labels, series in botmod.DB_QUERY_SECONDS.series.items()}
+
+
+def acquire_count() -> int:
+    return sum(series[-1] for series in botmod.DB_ACQUIRE_SECONDS.series.values())
+
+
+async def run_scenario(name: str, fake_bot: Bot, total: int, users: int, concurrency: int, update_ids):
+    texts = scenario_texts(name)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        update = make_update(next(update_ids), BENCH_USER_BASE + i % users, texts[i % len(texts)])
+        async with semaphore:
+            started = time.perf_counter()
+            await botmod.dp.feed_update(fake_bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    queries, acquires, calls = query_counts(), acquire_count(), fake_bot.session.calls
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    # Отложенная запись пользователей тоже часть нагрузки сценария
+    await botmod.user_activity.flush()
+    elapsed = time.perf_counter() - started
+
+    p = statistics.quantiles(latencies, n=100)
+    per_query = {name: count - queries.get(name, 0) for name, count in query_counts().items()}
+    per_query = {name: count for name, count in per_query.items() if count}
+    print(
+        f"{name:<8} {total / elapsed:>9.0f} upd/s  "
+        f"p50 {p[49] * 1000:>7.2f} ms  p95 {p[94] * 1000:>7.2f} ms  p99 {p[98] * 1000:>7.2f} ms  "
+        f"db {sum(per_query.values()) / total:>5.2f} q/upd  "
+        f"pool {(acquire_count() - acquires) / total:>5.2f} acq/upd  "
+        f"api {(fake_bot.session.calls - calls) / total:>5.2f} calls/upd"
+    )
+    if per_query:
+        top = sorted(per_query.items(), key=lambda item: -item[1])[:5]
+        print("         " + ", ".join(f"{name} {count / total:.2f}" for name, count in top))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=5000, help="обновлений на сценарий")
+    parser.add_argument("--users", type=int, default=5000, help="разных пользователей")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--log-pipeline", choices=("queue", "sync"), default="queue")
+    parser.add_argument("--log-format", choices=("text", "json"), default=botmod.LOGGING_CONFIG["log_format"])
+    parser.add_argument("--log-output", default=os.devnull, help="файл для журнала")
+    args = parser.parse_args()
+
+    log_output = open(args.log_output, "a", encoding="utf-8")
+    botmod.setup_logging(
+        **{**botmod.LOGGING_CONFIG, "level": args.log_level, "log_format": args.log_format},
+        stream=log_output,
+        use_queue=args.log_pipeline == "queue",
+    )
+    botmod.METRICS_CONFIG = None
+    botmod.PROBE_CONFIG = None
+    botmod.MEDIA_PREWARM_CHAT_ID = None
+
+    fake_bot = Bot(token=botmod.BOT_TOKEN, session=FakeSession())
+    botmod.bot = fake_bot
+    # Лимиты частоты рассчитаны на живых пользователей, а не на синтетический поток
+    for middleware in list(botmod.dp.message.outer_middleware):
+        if isinstance(middleware, botmod.ThrottlingMiddleware):
+            botmod.dp.message.outer_middleware.unregister(middleware)
+
+    await botmod.on_startup()
+    # Сценарии берут тексты из каталога, который загружается в фоне
+    await botmod.catalog.loaded.wait()
+    try:
+        # Заявки ссылаются на пользователей, поэтому сначала регистрируем всех
+        for i in range(args.users):
+            await botmod.register_user(BENCH_USER_BASE + i, "bench", "Bench")
+        await botmod.user_activity.flush()
+
+        update_ids = itertools.count(1)
+        for name in args.scenarios:
+            await run_scenario(name, fake_bot, args.updates, args.users, args.concurrency, update_ids)
+    finally:
+        await botmod.request_batcher.stop()
+        async with botmod.db_pool.acquire() as conn:
+            # Заявки удаляются явно: каскадное удаление не обновляет счетчики /stats
+            await conn.execute("DELETE FROM requests WHERE user_id >= $1", BENCH_USER_BASE)
+            await conn.execute("DELETE FROM users WHERE user_id >= $1", BENCH_USER_BASE)
+            # Иначе при следующем прогоне те же message_id сочтутся повторами
+            await conn.execute("DELETE FROM request_keys WHERE user_id >= $1", BENCH_USER_BASE)
+        await botmod.on_shutdown()
+        botmod.stop_logging()
+        dropped = botmod.log_sampler.dropped + getattr(botmod.log_handler, "dropped", 0)
+        print(f"log      {args.log_pipeline}/{args.log_format}, отброшено записей: {dropped}")
+        log_output.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
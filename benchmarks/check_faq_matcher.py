@@ -0,0 +1,57 @@
+"""Проверка нечеткого поиска по FAQ на вопросах из начального наполнения.
+
+Перефразированный вопрос должен получать ответ из FAQ, а сообщение, в
+котором к вопросу добавлено содержание заявки, должно уходить в заявки:
+ложное совпадение теряет заявку. При изменении FAQ_MATCH_THRESHOLD или
+FAQ_MATCH_COVERAGE прогон показывает, какие случаи сместились.
+
+Запуск из корня репозитория:
+    python benchmarks/check_faq_matcher.py
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+# Вопросы из init_faq_data
+FAQ = {
+    "Что такое IT-аутсорсинг?": "",
+    "Преимущества аутсорсинга": "",
+    "Как оформить заказ?": "",
+}
+
+# Текст сообщения -> ожидаемый вопрос FAQ или None, если это заявка
+CASES = {
+    "как оформить заказ": "Как оформить заказ?",
+    "Как оформит заказ": "Как оформить заказ?",
+    "оформить заказ": "Как оформить заказ?",
+    "что такое аутсорсинг": "Что такое IT-аутсорсинг?",
+    "Что такое ИТ аутсорсинг": "Что такое IT-аутсорсинг?",
+    "преимущества аутсорсинга?": "Преимущества аутсорсинга",
+    "Какие преимущества у аутсорсинга?": "Преимущества аутсорсинга",
+    "Хочу оформить заказ на лендинг": None,
+    "Как оформить заказ на лендинг?": None,
+    "Как оформить заказ? Нужен лендинг": None,
+    "оформить заказ на бота": None,
+    "Что такое аутсорсинг и сколько стоит сайт": None,
+    "Нужен сайт для проекта, бюджет 50 000₽": None,
+}
+
+
+def main():
+    matcher = bot.FaqMatcher(FAQ)
+    failed = 0
+    for text, expected in CASES.items():
+        match = matcher.match(text)
+        question = match[0] if match else None
+        ok = question == expected
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {text!r} -> {question!r}" + ("" if ok else f", ожидалось {expected!r}"))
+    print(f"{len(CASES) - failed}/{len(CASES)} случаев совпали с ожидаемым")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,174 @@
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import html
+import functools
+import glob
+import gzip
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import sqlite3
+import tempfile
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import asyncpg
-from aiogram import Bot, Dispatcher, types, F
+import aiohttp
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # Redis нужен только для общих счетчиков между репликами
+    aioredis = None
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # openpyxl нужен только для выгрузки в XLSX
+    Workbook = None
+from aiogram.types import FSInputFile, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+
+# Настройка логирования: записи передаются в очередь и пишутся в фоновом потоке,
+# поэтому вывод логов не занимает цикл событий
+LOGGING_CONFIG = {
+    "level": "INFO",
+    "log_format": "text",   # "text" или "json" - одна JSON-строка на запись
+    "queue_size": 10_000,   # при переполнении записи отбрасываются, а не задерживают обработку
+    # Доля сохраняемых записей уровня INFO и ниже от шумных логгеров (по окончанию имени)
+    "sampling": {
+        "aiogram.event": 0.01,  # строка на каждое обработанное обновление
+        "activity": 0.1,
+        "dedup": 0.1,
+    },
+}
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропуск каждой N-й записи уровня INFO и ниже от логгеров из rates; остальные уровни не трогаются"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+        self._periods = {}  # имя логгера -> N (1 - пропускать все, 0 - ни одной)
+        self._counts = {}
+
+    def _period(self, name: str) -> int:
+        period = self._periods.get(name)
+        if period is None:
+            period = 1
+            for suffix, rate in self.rates.items():
+                if name == suffix or name.endswith("." + suffix):
+                    period = max(1, round(1 / rate)) if rate > 0 else 0
+                    break
+            self._periods[name] = period
+        return period
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        period = self._period(record.name)
+        if period == 1:
+            return True
+        count = self._counts.get(record.name, 0)
+        self._counts[record.name] = count + 1
+        if period and count % period == 0:
+            return True
+        self.dropped += 1
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Передача записей фоновому потоку без форматирования и без ожидания места в очереди"""
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение форматируется в потоке QueueListener, а не в обработчике обновления
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_listener: logging.handlers.QueueListener = None
+log_handler: logging.Handler = None
+log_sampler: SamplingFilter = None
+
+def setup_logging(level: str, log_format: str, queue_size: int, sampling: dict, stream=None,
+                  use_queue: bool = True):
+    """(Пере)настройка корневого логгера; use_queue=False - прежний синхронный вывод"""
+    global log_listener, log_handler, log_sampler
+    stop_logging()
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(LOG_TEXT_FORMAT))
+    if use_queue:
+        log_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+        log_listener = logging.handlers.QueueListener(log_handler.queue, output)
+        log_listener.start()
+    else:
+        log_handler = output
+    log_sampler = SamplingFilter(sampling)
+    log_handler.addFilter(log_sampler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(log_handler)
+    root.setLevel(level)
+
+def stop_logging():
+    """Запись оставшихся в очереди сообщений и остановка фонового потока"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+setup_logging(**LOGGING_CONFIG)
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота и базы данных
 BOT_TOKEN = "ваш токен"
 START_IMAGE_URL = "https://i.postimg.cc/TYyS5w9n/Flux-Dev-Create-a-captivating-book-cover-for-ITAYTSORSING-feat-1.jpg"
+# Медиафайлы бота: ключ -> исходный URL. После первой отправки используется file_id Telegram
+MEDIA = {
+    "start_banner": START_IMAGE_URL,
+}
+# Чат для загрузки медиа при старте (например, ID администратора); None - загружать при первой отправке
+MEDIA_PREWARM_CHAT_ID = None
 DB_CONFIG = {
     "user": "",
     "password": "",  
@@ -22,75 +176,887 @@ DB_CONFIG = {
     "host": "",
     "port": ,
 }
+# Настройки пула соединений
+DB_POOL_CONFIG = {
+    "min_size": 1,
+    "max_size": 10,
+    "max_inactive_connection_lifetime": 60,
+    "timeout": 30,                # ожидание нового соединения, секунды
+    "command_timeout": 30,        # ограничение на выполнение запроса, секунды
+    "statement_cache_size": 100,  # кэш asyncpg для запросов вне реестра QUERIES
+}
+# Реплики только для чтения: параметры, отличающиеся от DB_CONFIG, например
+# {"host": "127.0.0.1", "port": 5433}. Пустой список - все запросы идут в основную БД
+DB_REPLICAS = []
+REPLICA_CONFIG = {
+    "sticky_seconds": 5,        # после записи пользователя его чтения идут в основную БД
+    "max_lag": 2.0,             # реплика с большим отставанием не используется, секунды
+    "check_interval": 1.0,      # период проверки отставания реплик, секунды
+    "max_sticky_users": 100_000,
+}
+
+# Защита от недоступной БД: при большой доле ошибок запросы сразу отклоняются, а не ждут таймаутов
+CIRCUIT_BREAKER_CONFIG = {
+    "failure_threshold": 0.5,  # доля ошибок соединения в окне, после которой цепь размыкается
+    "min_calls": 10,           # меньше вызовов в окне - решение не принимается
+    "window": 30,              # секунды
+    "reset_timeout": 15,       # через сколько секунд пропустить пробный запрос
+    "acquire_timeout": 3,      # ожидание свободного соединения пула, секунды
+}
+# Локальный журнал заявок и регистраций на время недоступности БД (SQLite)
+SPOOL_CONFIG = {
+    "path": "spool.sqlite3",
+    "replay_batch": 500,       # записей журнала в одной транзакции при переносе в БД
+    "replay_interval": 5,      # секунд между попытками переноса
+}
+
+# Режим получения обновлений: "polling" (long polling) или "webhook"
+UPDATES_MODE = "polling"
+WEBHOOK_CONFIG = {
+    "base_url": "",          # публичный адрес балансировщика, например https://bot.example.com
+    "path": "/webhook",
+    "secret_token": "",      # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+    "host": "0.0.0.0",
+    "port": 8080,
+    "max_concurrency": 64,   # сколько обновлений обрабатывается одновременно
+    "max_in_flight": 1000,   # сколько принятых обновлений может ждать обработки
+}
+# Многопроцессный режим: основной процесс принимает обновления (polling или webhook)
+# и распределяет их по WORKERS процессам по chat_id; 1 - обычный однопроцессный режим
+WORKERS = 1
+# Соединений к БД на все процессы вместе; делится между пулами воркеров
+DB_CONNECTION_BUDGET = 40
+# Наблюдение основного процесса за воркерами
+WORKER_SUPERVISION = {
+    "check_interval": 1.0,  # секунд между проверками, жив ли каждый воркер
+    "max_restarts": 5,      # перезапусков одного воркера за restart_window, после которых бот останавливается
+    "restart_window": 60,   # секунды
+    "put_timeout": 5,       # секунд ожидания места в очереди воркера в режиме polling
+}
+# Адрес Bot API; для локальных тестов можно указать заглушку Telegram, например http://127.0.0.1:8081
+TELEGRAM_API_URL = ""
+
+# Отложенная запись активности пользователей: сброс раз в интервал или при накоплении строк
+USER_ACTIVITY_FLUSH_INTERVAL = 0.5  # секунды
+USER_ACTIVITY_FLUSH_ROWS = 500
+
+# Заявки, пришедшие почти одновременно, объединяются в один многострочный INSERT
+REQUEST_BATCH_WINDOW = 0.005  # секунды
+REQUEST_BATCH_MAX_SIZE = 100
+
+# Количество записей на странице в /requests и /users
+ADMIN_PAGE_SIZE = 10
+# Период сводок /stats в днях и число вариантов услуг в топе
+STATS_DAYS = 7
+STATS_TOP_OPTIONS = 5
+
+# Строк в одном DELETE при пакетном удалении заявок; каждая порция - отдельная короткая транзакция
+REQUEST_DELETE_BATCH = 5000
+
+# Помесячные партиции таблицы заявок
+REQUESTS_PARTITION_CONFIG = {
+    "months_ahead": 3,          # партиций, создаваемых заранее
+    "retention_months": 12,     # более старые партиции архивируются и удаляются; None - хранить все
+    "archive_dir": "archive",   # каталог для CSV.gz удаляемых партиций; None - удалять без выгрузки
+    "interval": 6 * 3600,       # секунд между проверками
+    "request_keys_ttl": 48 * 3600,  # сколько хранить ключи идемпотентности заявок, секунды
+}
+
+# Минимальная похожесть (0..1) свободного текста на вопрос FAQ, при которой отвечаем из FAQ
+FAQ_MATCH_THRESHOLD = 0.6
+# Минимальная доля веса текста, покрытая триграммами вопроса FAQ: сообщение с заметной
+# добавкой к вопросу ("Хочу оформить заказ на лендинг") - это заявка, а не вопрос
+FAQ_MATCH_COVERAGE = 0.7
+
+# Общее хранилище ключ-значение для нескольких реплик, например redis://127.0.0.1:6379/0.
+# Необязательно: без него все счетчики хранятся в памяти процесса
+REDIS_URL = ""
+
+# Массовые рассылки (/broadcast)
+BROADCAST_CONFIG = {
+    "rate": 25,             # сообщений в секунду; запас до глобального лимита оставлен для ответов пользователям
+    "workers": 10,          # одновременных отправок
+    "chunk_size": 250,      # получателей между сохранениями прогресса
+    "report_interval": 10,  # секунд между обновлениями отчета администратору
+    "lease_timeout": 60,    # секунд без сохранения прогресса, после которых рассылку подхватит другой процесс
+}
+
+# HTTP-сервер с метриками в формате Prometheus (GET /metrics); None - не запускать
+METRICS_CONFIG = {
+    "host": "127.0.0.1",
+    "port": 9100,
+}
+# Пробы живости (GET /healthz) и готовности (GET /readyz) для балансировщика и оркестратора;
+# не зависят от METRICS_CONFIG. При WORKERS > 1 их отдает основной процесс. None - не запускать
+PROBE_CONFIG = {
+    "host": "0.0.0.0",
+    "port": 8090,
+}
+
+# Ограничение частоты входящих сообщений от одного пользователя (token bucket)
+RATE_LIMIT_CONFIG = {
+    "rate": 1.0,             # токенов в секунду
+    "burst": 5,              # емкость ведра
+    "max_buckets": 100_000,  # давно неактивные ведра вытесняются
+    "shared_window": 10,     # окно общего счетчика в Redis, секунды
+}
+# Повторно доставленные обновления (рестарт, повтор webhook) отбрасываются по update_id.
+# Telegram хранит неполученные обновления до суток, поэтому ttl не меньше этого срока
+DEDUP_CONFIG = {
+    "max_size": 100_000,  # update_id в памяти процесса
+    "ttl": 24 * 3600,     # секунды; с Redis ключи общие для всех реплик
+}
+# Ограничения Telegram на исходящие сообщения
+SEND_LIMIT_CONFIG = {
+    "global_rate": 30,       # сообщений в секунду на бота
+    "chat_rate": 1,          # сообщений в секунду в один чат
+    "chat_burst": 3,         # короткие серии ответов в чат без ожидания
+    "max_chats": 100_000,
+    "max_retries": 3,        # повторы после RetryAfter
+}
 
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
 # Глобальный пул соединений
 db_pool: asyncpg.pool.Pool = None
+# Отдельное соединение для LISTEN/NOTIFY об изменениях каталога
+catalog_listener: asyncpg.Connection = None
+
+if REDIS_URL and aioredis is None:
+    logger.warning("REDIS_URL задан, но пакет redis не установлен; счетчики будут локальными")
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL and aioredis else None
+
+# ================== РЕЕСТР ЗАПРОСОВ ==================
+
+# Постраничный просмотр по ключу (дата, id): страница не зависит от OFFSET
+# и читается по индексу независимо от размера таблицы
+ADMIN_LISTINGS = {
+    "requests": {
+        "table": "requests",
+        "columns": "request_id, user_id, request_date, status, left(request_text, 50) AS request_text",
+        "date": "request_date",
+        "id": "request_id",
+    },
+    "users": {
+        "table": "users",
+        "columns": "user_id, full_name, username, registration_date",
+        "date": "registration_date",
+        "id": "user_id",
+    },
+}
+
+def listing_queries(listing: str, cfg: dict) -> dict:
+    """Запросы первой страницы и листания к более старым/новым записям"""
+    select = f"SELECT {cfg['columns']} FROM {cfg['table']}"
+    key = f"({cfg['date']}, {cfg['id']})"
+    return {
+        f"{listing}_page_first": f'''
+            {select}
+            ORDER BY {cfg['date']} DESC, {cfg['id']} DESC
+            LIMIT $1
+        ''',
+        f"{listing}_page_older": f'''
+            {select}
+            WHERE {key} < ($1, $2)
+            ORDER BY {cfg['date']} DESC, {cfg['id']} DESC
+            LIMIT $3
+        ''',
+        f"{listing}_page_newer": f'''
+            {select}
+            WHERE {key} > ($1, $2)
+            ORDER BY {cfg['date']} ASC, {cfg['id']} ASC
+            LIMIT $3
+        ''',
+    }
+
+# Запросы горячего пути. Каждый подготавливается один раз при открытии
+# соединения пула и вызывается по имени: conn.statements["имя"].
+# Списки колонок указаны явно, чтобы подготовленный запрос не ломался
+# при добавлении колонок в таблицы.
+QUERIES = {
+    "upsert_users": '''
+        INSERT INTO users (user_id, username, full_name)
+        SELECT * FROM unnest($1::bigint[], $2::varchar[], $3::varchar[])
+        ON CONFLICT (user_id)
+        DO UPDATE SET last_activity = NOW(), username = EXCLUDED.username, full_name = EXCLUDED.full_name,
+                      is_blocked = FALSE
+    ''',
+    # Заявка с message_id создается, только если ключ (user_id, message_id) вставлен впервые
+    "create_request": '''
+        WITH input AS (
+            SELECT nextval(pg_get_serial_sequence('requests', 'request_id')) AS request_id
+        ), new_keys AS (
+            INSERT INTO request_keys (user_id, message_id, request_id)
+            SELECT $1, $4, request_id FROM input WHERE $4::bigint IS NOT NULL
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING request_id
+        )
+        INSERT INTO requests (request_id, user_id, request_text, service_option_id)
+        SELECT request_id, $1, $2, $3 FROM input
+        WHERE $4::bigint IS NULL OR request_id IN (SELECT request_id FROM new_keys)
+        RETURNING request_id
+    ''',
+    "create_requests": '''
+        WITH input AS (
+            SELECT t.*, nextval(pg_get_serial_sequence('requests', 'request_id')) AS request_id
+            FROM unnest($1::bigint[], $2::text[], $3::integer[], $4::bigint[], $5::timestamp[])
+                WITH ORDINALITY AS t(user_id, request_text, service_option_id, message_id, request_date, ord)
+        ), new_keys AS (
+            INSERT INTO request_keys (user_id, message_id, request_id)
+            SELECT user_id, message_id, request_id FROM input WHERE message_id IS NOT NULL
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING request_id
+        ), accepted AS (
+            SELECT * FROM input
+            WHERE message_id IS NULL OR request_id IN (SELECT request_id FROM new_keys)
+        ), inserted AS (
+            INSERT INTO requests (request_id, user_id, request_text, service_option_id, request_date)
+            SELECT request_id, user_id, request_text, service_option_id, COALESCE(request_date, NOW())
+            FROM accepted
+        )
+        SELECT accepted.request_id
+        FROM input LEFT JOIN accepted USING (ord)
+        ORDER BY input.ord
+    ''',
+    "catalog_services": "SELECT service_id, name, description FROM services ORDER BY service_id",
+    "catalog_options": '''
+        SELECT so.option_id, so.service_id, so.name, so.description, so.price, s.name AS service_name
+        FROM service_options so
+        JOIN services s ON so.service_id = s.service_id
+        ORDER BY so.option_id
+    ''',
+    "catalog_faq": "SELECT faq_id, question, answer FROM faq ORDER BY faq_id",
+    "media_all": "SELECT media_key, file_id FROM media_cache",
+    "media_save": '''
+        INSERT INTO media_cache (media_key, file_id)
+        VALUES ($1, $2)
+        ON CONFLICT (media_key) DO UPDATE SET file_id = EXCLUDED.file_id, updated_at = NOW()
+    ''',
+    "media_delete": "DELETE FROM media_cache WHERE media_key = $1",
+    # Сводки /stats читают только request_stats и user_stats, размер requests и users не важен
+    "stats_requests_by_day": '''
+        SELECT day, SUM(requests) AS requests
+        FROM request_stats
+        WHERE day > CURRENT_DATE - $1::integer
+        GROUP BY day
+        ORDER BY day DESC
+    ''',
+    "stats_requests_by_status": '''
+        SELECT status, SUM(requests) AS requests
+        FROM request_stats
+        GROUP BY status
+        HAVING SUM(requests) > 0
+        ORDER BY requests DESC
+    ''',
+    "stats_top_options": '''
+        SELECT so.name, SUM(rs.requests) AS requests
+        FROM request_stats rs
+        JOIN service_options so ON so.option_id = rs.option_key
+        WHERE rs.day > CURRENT_DATE - $1::integer
+        GROUP BY so.name
+        HAVING SUM(rs.requests) > 0
+        ORDER BY requests DESC
+        LIMIT $2
+    ''',
+    "stats_users": '''
+        SELECT
+            COALESCE(SUM(registered), 0) AS total,
+            COALESCE(SUM(registered) FILTER (WHERE day = CURRENT_DATE), 0) AS new_today,
+            COALESCE(SUM(registered) FILTER (WHERE day > CURRENT_DATE - $1::integer), 0) AS new_period,
+            COALESCE(SUM(last_active) FILTER (WHERE day = CURRENT_DATE), 0) AS active_today,
+            COALESCE(SUM(last_active) FILTER (WHERE day > CURRENT_DATE - $1::integer), 0) AS active_period
+        FROM user_stats
+    ''',
+    "broadcast_recipients": '''
+        SELECT user_id FROM users
+        WHERE user_id > $1 AND NOT is_blocked
+        ORDER BY user_id
+        LIMIT $2
+    ''',
+    "broadcast_checkpoint": '''
+        UPDATE broadcasts
+        SET last_user_id = $2, sent = sent + $3, failed = failed + $4, blocked = blocked + $5,
+            heartbeat_at = NOW()
+        WHERE broadcast_id = $1
+        RETURNING status
+    ''',
+    # Захват рассылок без владельца: новых, прерванных перезапуском или упавшим процессом
+    "broadcast_claim": '''
+        UPDATE broadcasts SET heartbeat_at = NOW()
+        WHERE status = 'running' AND heartbeat_at < NOW() - make_interval(secs => $1)
+        RETURNING broadcast_id, admin_id, text, last_user_id, sent, failed, blocked
+    ''',
+    "broadcast_finish": "UPDATE broadcasts SET status = $2, finished_at = NOW() WHERE broadcast_id = $1",
+    "mark_users_blocked": "UPDATE users SET is_blocked = TRUE WHERE user_id = ANY($1::bigint[])",
+}
+for _listing, _cfg in ADMIN_LISTINGS.items():
+    QUERIES.update(listing_queries(_listing, _cfg))
+
+class TimedStatement:
+    """Подготовленный запрос реестра с замером времени под его именем.
+
+    asyncpg вызывает логгеры запросов только для Connection.execute/fetch*,
+    но не для PreparedStatement, поэтому запросы реестра замеряются здесь.
+    """
+
+    def __init__(self, name: str, statement: asyncpg.prepared_stmt.PreparedStatement):
+        self.name = name
+        self._statement = statement
+
+    async def _timed(self, call):
+        started = time.perf_counter()
+        try:
+            return await call
+        except Exception:
+            DB_QUERY_ERRORS_TOTAL.inc(self.name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, self.name)
+
+    def fetch(self, *args, **kwargs):
+        return self._timed(self._statement.fetch(*args, **kwargs))
+
+    def fetchrow(self, *args, **kwargs):
+        return self._timed(self._statement.fetchrow(*args, **kwargs))
+
+    def fetchval(self, *args, **kwargs):
+        return self._timed(self._statement.fetchval(*args, **kwargs))
+
+    async def cursor(self, *args, **kwargs):
+        """Курсор замеряется целиком, от первой до последней строки"""
+        started = time.perf_counter()
+        try:
+            async for record in self._statement.cursor(*args, **kwargs):
+                yield record
+        except Exception:
+            DB_QUERY_ERRORS_TOTAL.inc(self.name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, self.name)
+
+class BotConnection(asyncpg.Connection):
+    """Соединение пула с подготовленными запросами из реестра QUERIES"""
+
+    async def prepare_registry(self):
+        self.statements = {
+            name: TimedStatement(name, await self.prepare(query)) for name, query in QUERIES.items()
+        }
 
 # ================== ПОДКЛЮЧЕНИЕ К БАЗЕ ДАННЫХ ==================
 
-async def create_db_pool():
-    return await asyncpg.create_pool(
-        **DB_CONFIG,
-        min_size=1,
-        max_size=10,
-        max_inactive_connection_lifetime=60,
-        timeout=30
+async def setup_connection(conn: BotConnection):
+    """Вызывается пулом один раз для каждого нового соединения"""
+    conn.add_query_logger(observe_query)
+    await conn.prepare_registry()
+
+async def create_db_pool(overrides: dict = None):
+    """Пул к основной БД или, с overrides из DB_REPLICAS, к реплике.
+
+    Пул основной БД работает через db_breaker; у реплик свой учет ошибок в db_router.
+    """
+    pool = await asyncpg.create_pool(
+        **{**DB_CONFIG, **(overrides or {})},
+        **DB_POOL_CONFIG,
+        connection_class=BotConnection,
+        init=setup_connection
     )
+    return InstrumentedPool(pool, breaker=db_breaker if overrides is None else None)
+
+# Отставание реплики в секундах; 0, если применен весь полученный WAL или это не реплика
+REPLICA_LAG_QUERY = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+# Ошибки, после которых чтение повторяется в основной БД
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError,
+                  asyncpg.CannotConnectNowError)
+
+class DatabaseRouter:
+    """Распределение запросов между основной БД (db_pool) и репликами.
+
+    Записи всегда идут в основную БД. Чтения распределяются по кругу между
+    исправными репликами; чтения пользователя в течение sticky_seconds после
+    его записи идут в основную БД, чтобы он сразу видел свои изменения.
+    Реплика с отставанием больше max_lag или с ошибкой соединения исключается
+    до следующей успешной проверки, а неудавшееся чтение повторяется в основной БД.
+    """
+
+    def __init__(self, replicas: list, sticky_seconds: float, max_lag: float, check_interval: float,
+                 max_sticky_users: int):
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.max_sticky_users = max_sticky_users
+        self.pools = [None] * len(replicas)
+        self.healthy = [False] * len(replicas)
+        self._recent_writes = OrderedDict()  # user_id -> время записи, от старых к новым
+        self._turn = 0
+        self._task = None
+
+    def mark_write(self, user_id: int):
+        self._recent_writes[user_id] = time.monotonic()
+        self._recent_writes.move_to_end(user_id)
+        while len(self._recent_writes) > self.max_sticky_users:
+            self._recent_writes.popitem(last=False)
+
+    def _is_sticky(self, user_id: int) -> bool:
+        written = self._recent_writes.get(user_id)
+        if written is None:
+            return False
+        if time.monotonic() - written < self.sticky_seconds:
+            return True
+        del self._recent_writes[user_id]
+        return False
+
+    def _pick_replica(self) -> int:
+        for _ in range(len(self.pools)):
+            index = self._turn % len(self.pools)
+            self._turn += 1
+            if self.healthy[index]:
+                return index
+        return None
+
+    async def read(self, work, user_id: int = None):
+        """Выполнение work(conn) на реплике или, если подходящей нет, в основной БД"""
+        index = None if user_id is not None and self._is_sticky(user_id) else self._pick_replica()
+        if index is not None:
+            try:
+                async with self.pools[index].acquire() as conn:
+                    return await work(conn)
+            except REPLICA_ERRORS as e:
+                self._set_health(index, False, f"ошибка чтения: {e}")
+        async with db_pool.acquire() as conn:
+            return await work(conn)
+
+    def _set_health(self, index: int, healthy: bool, reason: str):
+        if self.healthy[index] != healthy:
+            state = "используется" if healthy else "исключена"
+            logger.warning("Реплика %s %s: %s", self.replicas[index], state, reason)
+        self.healthy[index] = healthy
+
+    async def _check(self, index: int):
+        try:
+            if self.pools[index] is None:
+                self.pools[index] = await create_db_pool(self.replicas[index])
+            async with self.pools[index].acquire(timeout=self.check_interval * 5) as conn:
+                lag = await conn.fetchval(REPLICA_LAG_QUERY)
+        except Exception as e:
+            self._set_health(index, False, f"недоступна: {e}")
+            return
+        if lag > self.max_lag:
+            self._set_health(index, False, f"отставание {lag:.1f} с")
+        else:
+            self._set_health(index, True, f"отставание {lag:.1f} с")
+
+    async def _monitor(self):
+        while True:
+            await asyncio.gather(*(self._check(index) for index in range(len(self.pools))))
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self.replicas:
+            self._task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*(pool.close() for pool in self.pools if pool is not None))
+
+db_router = DatabaseRouter(DB_REPLICAS, **REPLICA_CONFIG)
+
+# ================== МИГРАЦИИ СХЕМЫ ==================
+
+# Сводные счетчики для /stats поддерживаются триггерами уровня команды: изменения
+# читаются из переходных таблиц и добавляются к счетчикам одним INSERT ... ON CONFLICT.
+# Переходные таблицы допустимы только у триггера на одно событие, поэтому триггеров три.
+STATS_TRIGGER_SOURCES = {
+    "INSERT": (("new_rows", 1),),
+    "UPDATE": (("old_rows", -1), ("new_rows", 1)),
+    "DELETE": (("old_rows", -1),),
+}
 
-async def init_db(pool: asyncpg.pool.Pool):
-    """Инициализация структуры базы данных"""
-    async with pool.acquire() as conn:
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username VARCHAR(100),
-                full_name VARCHAR(200) NOT NULL,
-                registration_date TIMESTAMP DEFAULT NOW(),
-                last_activity TIMESTAMP DEFAULT NOW()
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS services (
-                service_id SERIAL PRIMARY KEY,
-                name VARCHAR(100) NOT NULL,
-                description TEXT
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS service_options (
-                option_id SERIAL PRIMARY KEY,
-                service_id INTEGER REFERENCES services(service_id) ON DELETE CASCADE,
-                name VARCHAR(100) NOT NULL,
-                description TEXT,
-                price VARCHAR(100)
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS requests (
-                request_id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                request_text TEXT NOT NULL,
-                request_date TIMESTAMP DEFAULT NOW(),
-                status VARCHAR(50) DEFAULT 'new',
-                service_option_id INTEGER REFERENCES service_options(option_id) ON DELETE SET NULL
+def stats_trigger_statements(table: str, summary: str, key_columns: str, value_columns: str,
+                             select_changes) -> list:
+    """Функции и триггеры, переносящие изменения table в сводную таблицу summary.
+
+    select_changes(source, sign) возвращает SELECT с колонками key_columns и
+    value_columns, где каждая строка source дает вклад sign в счетчики.
+    """
+    values = [column.strip() for column in value_columns.split(",")]
+    statements = []
+    for event, sources in STATS_TRIGGER_SOURCES.items():
+        function = f"{summary}_{event.lower()}"
+        changes = " UNION ALL ".join(select_changes(source, sign) for source, sign in sources)
+        referencing = " ".join(
+            f"{'NEW' if source == 'new_rows' else 'OLD'} TABLE AS {source}" for source, _ in sources
+        )
+        statements += [
+            f'''
+            CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {summary} ({key_columns}, {value_columns})
+                SELECT {key_columns}, {", ".join(f"SUM({value})" for value in values)}
+                FROM ({changes}) AS changes
+                GROUP BY {key_columns}
+                HAVING {" OR ".join(f"SUM({value}) <> 0" for value in values)}
+                -- Одинаковый порядок блокировок строк в конкурентных транзакциях
+                ORDER BY {key_columns}
+                ON CONFLICT ({key_columns}) DO UPDATE SET
+                    {", ".join(f"{value} = {summary}.{value} + EXCLUDED.{value}" for value in values)};
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            ''',
+            f"DROP TRIGGER IF EXISTS {function} ON {table}",
+            f'''
+            CREATE TRIGGER {function}
+            AFTER {event} ON {table}
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+            ''',
+        ]
+    return statements
+
+def request_stats_changes(source: str, sign: int) -> str:
+    return (
+        f"SELECT request_date::date AS day, COALESCE(status, '') AS status, "
+        f"COALESCE(service_option_id, 0) AS option_key, {sign} AS requests FROM {source}"
+    )
+
+def user_stats_changes(source: str, sign: int) -> str:
+    return (
+        f"SELECT registration_date::date AS day, {sign} AS registered, 0 AS last_active "
+        f"FROM {source} WHERE registration_date IS NOT NULL "
+        f"UNION ALL SELECT last_activity::date, 0, {sign} FROM {source} WHERE last_activity IS NOT NULL"
+    )
+
+# Миграции: (версия, описание, SQL-команды, выполнять ли в транзакции).
+# CREATE INDEX CONCURRENTLY не работает внутри транзакции, поэтому такие
+# миграции выполняются покомандно и должны быть идемпотентными.
+MIGRATIONS = [
+    (1, "Базовые таблицы", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(100),
+            full_name VARCHAR(200) NOT NULL,
+            registration_date TIMESTAMP DEFAULT NOW(),
+            last_activity TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS services (
+            service_id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            description TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS service_options (
+            option_id SERIAL PRIMARY KEY,
+            service_id INTEGER REFERENCES services(service_id) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            description TEXT,
+            price VARCHAR(100)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS requests (
+            request_id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+            request_text TEXT NOT NULL,
+            request_date TIMESTAMP DEFAULT NOW(),
+            status VARCHAR(50) DEFAULT 'new',
+            service_option_id INTEGER REFERENCES service_options(option_id) ON DELETE SET NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS faq (
+            faq_id SERIAL PRIMARY KEY,
+            question VARCHAR(200) NOT NULL,
+            answer TEXT NOT NULL
+        )
+        ''',
+    ], True),
+    # Уведомления об изменении каталога для сброса кэша во всех процессах бота
+    (2, "Триггеры NOTIFY на таблицах каталога", [
+        '''
+        CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        *(
+            statement
+            for table in ("services", "service_options", "faq")
+            for statement in (
+                f"DROP TRIGGER IF EXISTS catalog_changed ON {table}",
+                f'''
+                CREATE TRIGGER catalog_changed
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed()
+                ''',
             )
-        ''')
+        ),
+    ], True),
+    (3, "Индексы для постраничного просмотра в админ-панели", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS requests_request_date_idx
+        ON requests (request_date DESC, request_id DESC)
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS users_registration_date_idx
+        ON users (registration_date DESC, user_id DESC)
+        ''',
+    ], False),
+    (4, "Индексы и ограничения уникальности для поиска по каталогу и заявкам", [
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS faq_question_key ON faq (question)",
+        '''
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS service_options_service_id_name_key
+        ON service_options (service_id, name)
+        ''',
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS service_options_name_idx ON service_options (name)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS requests_user_id_idx ON requests (user_id)",
+        # Готовые уникальные индексы превращаются в ограничения без повторного построения
+        '''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'faq_question_key') THEN
+                ALTER TABLE faq ADD CONSTRAINT faq_question_key
+                UNIQUE USING INDEX faq_question_key;
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'service_options_service_id_name_key') THEN
+                ALTER TABLE service_options ADD CONSTRAINT service_options_service_id_name_key
+                UNIQUE USING INDEX service_options_service_id_name_key;
+            END IF;
+        END;
+        $$
+        ''',
+    ], False),
+    (5, "Кэш file_id загруженных медиафайлов", [
+        '''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            media_key VARCHAR(100) PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+    ], True),
+    (6, "Рассылки и отметка пользователей, заблокировавших бота", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT FALSE",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id SERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            last_user_id BIGINT,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT NOW(),
+            heartbeat_at TIMESTAMP DEFAULT NOW(),
+            finished_at TIMESTAMP
+        )
+        ''',
+    ], True),
+    (7, "Помесячное секционирование заявок", [
+        # Существующая таблица становится первой партицией, данные не копируются
+        "ALTER TABLE requests RENAME TO requests_legacy",
+        "ALTER INDEX IF EXISTS requests_request_date_idx RENAME TO requests_legacy_request_date_idx",
+        "ALTER INDEX IF EXISTS requests_user_id_idx RENAME TO requests_legacy_user_id_idx",
+        # Ключ партиционирования не может быть NULL и должен входить в первичный ключ
+        "UPDATE requests_legacy SET request_date = NOW() WHERE request_date IS NULL",
+        "ALTER TABLE requests_legacy ALTER COLUMN request_date SET NOT NULL",
+        "ALTER TABLE requests_legacy DROP CONSTRAINT requests_pkey",
+        "ALTER TABLE requests_legacy ADD CONSTRAINT requests_legacy_pkey PRIMARY KEY (request_id, request_date)",
+        '''
+        CREATE TABLE requests (
+            request_id INTEGER NOT NULL DEFAULT nextval('requests_request_id_seq'),
+            user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+            request_text TEXT NOT NULL,
+            request_date TIMESTAMP NOT NULL DEFAULT NOW(),
+            status VARCHAR(50) DEFAULT 'new',
+            service_option_id INTEGER REFERENCES service_options(option_id) ON DELETE SET NULL,
+            PRIMARY KEY (request_id, request_date)
+        ) PARTITION BY RANGE (request_date)
+        ''',
+        # create_requests берет номера через pg_get_serial_sequence('requests', ...)
+        "ALTER SEQUENCE requests_request_id_seq OWNED BY requests.request_id",
+        '''
+        DO $$
+        BEGIN
+            EXECUTE format(
+                'ALTER TABLE requests ATTACH PARTITION requests_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+                date_trunc('month', NOW()) + INTERVAL '1 month'
+            );
+        END
+        $$
+        ''',
+        # Индексы партиционированной таблицы подхватывают уже построенные индексы старой
+        "CREATE INDEX requests_request_date_idx ON requests (request_date DESC, request_id DESC)",
+        "CREATE INDEX requests_user_id_idx ON requests (user_id)",
+    ], True),
+    (8, "Ключи идемпотентности заявок", [
+        # Уникальность на партиционированной requests требует ключа партиции в индексе,
+        # поэтому ключи (user_id, message_id) хранятся в отдельной таблице
+        '''
+        CREATE TABLE IF NOT EXISTS request_keys (
+            user_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            request_id INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, message_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS request_keys_created_at_idx ON request_keys (created_at)",
+    ], True),
+    # Триггеры создаются до заполнения в той же транзакции: CREATE TRIGGER блокирует
+    # запись в таблицы, и ни одно изменение не будет пропущено или учтено дважды
+    (9, "Сводные счетчики заявок и пользователей для /stats", [
+        '''
+        CREATE TABLE IF NOT EXISTS request_stats (
+            day DATE NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            option_key INTEGER NOT NULL,  -- service_option_id, 0 - без варианта услуги
+            requests BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, status, option_key)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            day DATE PRIMARY KEY,
+            registered BIGINT NOT NULL DEFAULT 0,   -- зарегистрировались в этот день
+            last_active BIGINT NOT NULL DEFAULT 0   -- последняя активность приходится на этот день
+        )
+        ''',
+        *stats_trigger_statements("requests", "request_stats", "day, status, option_key", "requests",
+                                  request_stats_changes),
+        *stats_trigger_statements("users", "user_stats", "day", "registered, last_active",
+                                  user_stats_changes),
+        '''
+        INSERT INTO request_stats (day, status, option_key, requests)
+        SELECT day, status, option_key, SUM(requests)
+        FROM (''' + request_stats_changes("requests", 1) + ''') AS changes
+        GROUP BY day, status, option_key
+        ''',
+        '''
+        INSERT INTO user_stats (day, registered, last_active)
+        SELECT day, SUM(registered), SUM(last_active)
+        FROM (''' + user_stats_changes("users", 1) + ''') AS changes
+        GROUP BY day
+        ''',
+    ], True),
+]
+
+# Ключ advisory lock, чтобы несколько запущенных ботов не применяли миграции одновременно
+MIGRATIONS_LOCK_ID = 7_361_204
+# Интервал повторных попыток взять блокировку миграций, секунды
+MIGRATIONS_LOCK_POLL_INTERVAL = 0.5
+
+CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+async def get_schema_version(conn) -> int:
+    if await conn.fetchval("SELECT to_regclass('schema_version')") is None:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+async def drop_invalid_indexes(conn, statements: list):
+    """Удаление индексов миграции, оставшихся невалидными после прерванного CREATE INDEX CONCURRENTLY.
+
+    Затрагиваются только индексы, которые строит сама миграция: невалидным
+    бывает и индекс, который прямо сейчас строит кто-то другой.
+    """
+    index_names = [match for statement in statements for match in CONCURRENT_INDEX_RE.findall(statement)]
+    if not index_names:
+        return
+    names = await conn.fetch('''
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema() AND c.relname = ANY($1::text[])
+    ''', index_names)
+    for record in names:
+        logger.warning("Удаляем невалидный индекс %s", record['relname'])
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{record["relname"]}"')
+
+async def run_migrations(conn):
+    """Применение недостающих миграций; при актуальной схеме DDL не выполняется"""
+    latest = MIGRATIONS[-1][0]
+    if await get_schema_version(conn) >= latest:
+        return
+
+    # Ждем блокировку опросом, а не в pg_advisory_lock: ожидающий запрос держит снимок,
+    # и CREATE INDEX CONCURRENTLY у владельца блокировки ждал бы его до взаимоблокировки
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_ID):
+        await asyncio.sleep(MIGRATIONS_LOCK_POLL_INTERVAL)
+    try:
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS faq (
-                faq_id SERIAL PRIMARY KEY,
-                question VARCHAR(200) NOT NULL,
-                answer TEXT NOT NULL
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
             )
         ''')
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        current = await get_schema_version(conn)
+        for version, description, statements, transactional in MIGRATIONS:
+            if version <= current:
+                continue
+            if transactional:
+                async with conn.transaction():
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                        version, description
+                    )
+            else:
+                await drop_invalid_indexes(conn, statements)
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                    version, description
+                )
+            logger.info("Применена миграция %s: %s", version, description)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+async def init_db():
+    """Инициализация структуры базы данных.
+
+    Выполняется на отдельном соединении до создания пула: соединения пула
+    сразу подготавливают запросы реестра, и таблицы к этому моменту должны существовать.
+    """
+    conn = await asyncpg.connect(**DB_CONFIG)
+    try:
+        await run_migrations(conn)
+        await ensure_request_partitions(conn, REQUESTS_PARTITION_CONFIG["months_ahead"])
 
-        # Заполняем начальные данные, если таблицы пустые
-        if await conn.fetchval("SELECT COUNT(*) FROM services") == 0:
+        # Заполняем начальные данные, если таблицы пустые; EXISTS не читает таблицу целиком
+        has_services, has_faq = await conn.fetchrow(
+            "SELECT EXISTS (SELECT 1 FROM services), EXISTS (SELECT 1 FROM faq)"
+        )
+        if not has_services:
             await init_services_data(conn)
-        if await conn.fetchval("SELECT COUNT(*) FROM faq") == 0:
+        if not has_faq:
             await init_faq_data(conn)
+    finally:
+        await conn.close()
 
 async def init_services_data(conn):
     """Инициализация данных об услугах"""
@@ -178,114 +1144,1105 @@ async def init_faq_data(conn):
        "3. Заключим договор и приступим к работе\n"
        "4. Вы получите готовый продукт в согласованные сроки")
 
+# ================== ПАРТИЦИИ ЗАЯВОК ==================
+
+# Верхняя граница партиции в выводе pg_get_expr: FOR VALUES FROM (...) TO ('2024-02-01 00:00:00')
+PARTITION_UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+# Ключ advisory lock: партиции обслуживает только один из запущенных процессов
+PARTITIONS_LOCK_ID = 7_361_205
+
+def month_start(moment: datetime, shift: int = 0) -> datetime:
+    """Начало месяца, отстоящего от moment на shift месяцев"""
+    month = moment.year * 12 + moment.month - 1 + shift
+    return datetime(month // 12, month % 12 + 1, 1)
+
+async def ensure_request_partitions(conn, months_ahead: int):
+    """Создание партиций заявок на текущий и months_ahead следующих месяцев"""
+    now = datetime.now()
+    for shift in range(months_ahead + 1):
+        start, end = month_start(now, shift), month_start(now, shift + 1)
+        name = f"requests_{start:%Y_%m}"
+        if await conn.fetchval("SELECT to_regclass($1)", name) is not None:
+            continue
+        try:
+            await conn.execute(
+                f"CREATE TABLE {name} PARTITION OF requests "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            )
+        except asyncpg.InvalidObjectDefinitionError:
+            # Месяц уже покрыт другой партицией, например бывшей таблицей requests
+            continue
+        except asyncpg.DuplicateTableError:
+            # Партицию одновременно создал другой процесс
+            continue
+        logger.info("Создана партиция %s", name)
+
+async def request_partitions(conn) -> list:
+    """Партиции заявок в виде пар (имя, верхняя граница) от старых к новым"""
+    records = await conn.fetch('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'requests'::regclass
+    ''')
+    partitions = []
+    for record in records:
+        match = PARTITION_UPPER_BOUND_RE.search(record["bound"])
+        if match:
+            partitions.append((record["relname"], datetime.fromisoformat(match.group(1))))
+    partitions.sort(key=lambda partition: partition[1])
+    return partitions
+
+async def drop_request_partition(conn, name: str, upper: datetime):
+    """Отсоединение и удаление партиции без блокировки вставок в остальные партиции.
+
+    Партиции удаляются от старых к новым, поэтому вместе с партицией из сводки
+    /stats убираются все дни до ее верхней границы upper.
+    """
+    try:
+        await conn.execute(f'ALTER TABLE requests DETACH PARTITION "{name}" CONCURRENTLY')
+    except asyncpg.ObjectNotInPrerequisiteStateError:
+        # Предыдущее отсоединение было прервано на середине
+        await conn.execute(f'ALTER TABLE requests DETACH PARTITION "{name}" FINALIZE')
+    # DROP TABLE не вызывает триггеры на удаление строк
+    async with conn.transaction():
+        await conn.execute(f'DROP TABLE "{name}"')
+        await conn.execute("DELETE FROM request_stats WHERE day < $1", upper.date())
+    logger.info("Партиция %s удалена", name)
+
+async def dump_request_partition(conn, name: str, archive_dir: str) -> str:
+    """Выгрузка партиции в archive_dir/<имя>.csv.gz; возвращает путь к файлу"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    partial = f"{path}.part"
+    try:
+        with gzip.open(partial, "wb") as archive:
+            async def write_chunk(chunk: bytes):
+                await asyncio.to_thread(archive.write, chunk)
+
+            await conn.copy_from_table(name, output=write_chunk, format="csv", header=True)
+    except BaseException:
+        os.remove(partial)
+        raise
+    os.replace(partial, path)
+    return path
+
+class RequestArchiver:
+    """Обслуживание помесячных партиций заявок.
+
+    Заранее создает партиции на months_ahead месяцев вперед. Партиции старше
+    retention_months выгружаются в archive_dir, затем отсоединяются через
+    DETACH PARTITION CONCURRENTLY и удаляются - без долгого DELETE и без
+    блокировки вставок новых заявок. Заодно порциями удаляются ключи
+    идемпотентности старше request_keys_ttl.
+    """
+
+    def __init__(self, months_ahead: int, retention_months: int, archive_dir: str, interval: float,
+                 request_keys_ttl: float):
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.request_keys_ttl = request_keys_ttl
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error("Ошибка обслуживания партиций заявок: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def maintain(self):
+        async with db_pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", PARTITIONS_LOCK_ID):
+                return
+            try:
+                await ensure_request_partitions(conn, self.months_ahead)
+                # Повторы обновлений старше суток Telegram не присылает, старые ключи не нужны
+                await delete_in_batches(conn, '''
+                    DELETE FROM request_keys
+                    WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM request_keys
+                        WHERE created_at < NOW() - make_interval(secs => $1) LIMIT $2
+                    ))
+                ''', self.request_keys_ttl)
+                if self.retention_months is None:
+                    return
+                cutoff = month_start(datetime.now(), -self.retention_months)
+                for name, upper in await request_partitions(conn):
+                    if upper > cutoff:
+                        break
+                    # Выгрузка до отсоединения: при сбое партиция останется на месте
+                    if self.archive_dir is not None:
+                        path = await dump_request_partition(conn, name, self.archive_dir)
+                        logger.info("Партиция %s выгружена в %s", name, path)
+                    await drop_request_partition(conn, name, upper)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", PARTITIONS_LOCK_ID)
+
+request_archiver = RequestArchiver(**REQUESTS_PARTITION_CONFIG)
+
 # ================== ФУНКЦИИ ДЛЯ РАБОТЫ С БД ==================
-async def clear_all_requests():
-    """Очистка всех заявок из базы данных"""
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM requests")
-        logger.info("Все заявки удалены из базы данных")
+async def delete_in_batches(conn, query: str, *args) -> int:
+    """Повторение DELETE порциями по REQUEST_DELETE_BATCH строк.
+
+    Последний параметр запроса - размер порции. Каждая порция выполняется
+    отдельной короткой транзакцией и не держит блокировки до конца очистки.
+    """
+    total = 0
+    while True:
+        result = await conn.execute(query, *args, REQUEST_DELETE_BATCH)
+        deleted = int(result.split()[-1])
+        total += deleted
+        if deleted < REQUEST_DELETE_BATCH:
+            return total
 
-async def delete_request(request_id: int):
-    """Удаление конкретной заявки"""
-    async with db_pool.acquire() as conn:
-        deleted = await conn.execute("DELETE FROM requests WHERE request_id = $1", request_id)
-    return int(deleted.split()[-1]) > 0
+async def clear_all_requests():
+    """Очистка всех заявок из базы данных.
 
-async def delete_user(user_id: int):
-    """Удаление пользователя и всех его заявок"""
+    Партиции прошедших месяцев отсоединяются и удаляются целиком, из остальных
+    строки удаляются порциями, поэтому новые заявки создаются без ожидания.
+    """
+    current_month = month_start(datetime.now())
     async with db_pool.acquire() as conn:
-        deleted = await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
-    return int(deleted.split()[-1]) > 0
+        for name, upper in await request_partitions(conn):
+            if upper <= current_month:
+                await drop_request_partition(conn, name, upper)
+        # Удаление через родительскую таблицу, чтобы сработали триггеры счетчиков /stats
+        await delete_in_batches(conn, '''
+            DELETE FROM requests
+            WHERE (request_id, request_date) IN (SELECT request_id, request_date FROM requests LIMIT $1)
+        ''')
+    logger.info("Все заявки удалены из базы данных")
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d")
+
+# Объект удаления -> (таблица, колонка id, фильтры: имя -> (условие, разбор значения))
+BULK_DELETES = {
+    "requests": ("requests", "request_id", {
+        "user": ("user_id = ${}", int),
+        "status": ("status = ${}", str),
+        "before": ("request_date < ${}", parse_date),
+    }),
+    "users": ("users", "user_id", {
+        "before": ("registration_date < ${}", parse_date),
+    }),
+    "services": ("services", "service_id", {}),
+    "faq": ("faq", "faq_id", {}),
+}
 
-async def delete_service(service_id: int):
-    """Удаление услуги и связанных с ней вариантов"""
+def parse_delete_args(kind: str, args: list) -> tuple:
+    """Разбор аргументов команды удаления: номера, диапазоны 10-20 и фильтры key=value.
+
+    Номера можно перечислять через пробел или запятую. Возвращает (ids, ranges,
+    filters); ValueError - если аргументы не распознаны или ничего не выбрано.
+    """
+    allowed = BULK_DELETES[kind][2]
+    ids, ranges, filters = [], [], {}
+    for arg in (part for item in args for part in item.split(",") if part):
+        if "=" in arg:
+            key, value = arg.split("=", 1)
+            if key not in allowed:
+                raise ValueError(f"неизвестный фильтр {key}")
+            filters[key] = allowed[key][1](value)
+        elif "-" in arg:
+            low, high = arg.split("-", 1)
+            low, high = int(low), int(high)
+            ranges.append((min(low, high), max(low, high)))
+        else:
+            ids.append(int(arg))
+    if not (ids or ranges or filters):
+        raise ValueError("не указано, что удалять")
+    return ids, ranges, filters
+
+def bulk_delete_condition(kind: str, ids: list, ranges: list, filters: dict) -> tuple:
+    """Условие WHERE и его параметры: номера и диапазоны объединяются через OR, фильтры - через AND"""
+    _, id_column, allowed = BULK_DELETES[kind]
+    args, selected, conditions = [], [], []
+    if ids:
+        args.append(ids)
+        selected.append(f"{id_column} = ANY(${len(args)}::bigint[])")
+    # Отдельный BETWEEN на каждый диапазон: такое условие использует индекс первичного ключа,
+    # а EXISTS по unnest под OR выполнялся бы подзапросом для каждой строки таблицы
+    for low, high in ranges:
+        args += [low, high]
+        selected.append(f"{id_column} BETWEEN ${len(args) - 1} AND ${len(args)}")
+    if selected:
+        conditions.append(f"({' OR '.join(selected)})")
+    for key, value in filters.items():
+        args.append(value)
+        conditions.append(allowed[key][0].format(len(args)))
+    return " AND ".join(conditions), args
+
+async def bulk_delete(kind: str, ids: list, ranges: list, filters: dict) -> int:
+    """Удаление выбранных записей одним запросом в одной транзакции; возвращает число удаленных строк"""
+    table = BULK_DELETES[kind][0]
+    condition, args = bulk_delete_condition(kind, ids, ranges, filters)
     async with db_pool.acquire() as conn:
-        deleted = await conn.execute("DELETE FROM services WHERE service_id = $1", service_id)
-    return int(deleted.split()[-1]) > 0
+        if kind == "users":
+            # Заявки удаляются порциями заранее, чтобы каскадное удаление не трогало их одним запросом
+            await delete_in_batches(conn, f'''
+                DELETE FROM requests
+                WHERE (request_id, request_date) IN (
+                    SELECT request_id, request_date FROM requests
+                    WHERE user_id IN (SELECT user_id FROM users WHERE {condition})
+                    LIMIT ${len(args) + 1}
+                )
+            ''', *args)
+        async with conn.transaction():
+            result = await conn.execute(f"DELETE FROM {table} WHERE {condition}", *args)
+    deleted = int(result.split()[-1])
+    if deleted and kind in ("services", "faq"):
+        await catalog.load(db_pool)
+    return deleted
+
+async def get_listing_page(listing: str, cursor: tuple = None, backward: bool = False,
+                           limit: int = ADMIN_PAGE_SIZE, user_id: int = None):
+    """Получение страницы списка.
+
+    cursor - пара (дата, id) крайней записи предыдущей страницы; backward -
+    листать к более новым записям. Возвращает записи от новых к старым и флаг
+    наличия записей дальше в направлении листания. user_id - кто смотрит
+    список: сразу после своих изменений он читает из основной БД.
+    """
+    if cursor is None:
+        name, args = f"{listing}_page_first", (limit + 1,)
+    else:
+        name, args = f"{listing}_page_{'newer' if backward else 'older'}", (*cursor, limit + 1)
 
-async def delete_faq(faq_id: int):
-    """Удаление вопроса из FAQ"""
-    async with db_pool.acquire() as conn:
-        deleted = await conn.execute("DELETE FROM faq WHERE faq_id = $1", faq_id)
-    return int(deleted.split()[-1]) > 0
+    async def read_page(conn):
+        async with conn.transaction():
+            return [row async for row in conn.statements[name].cursor(*args)]
 
-async def get_all_requests():
-    """Получение всех заявок"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM requests ORDER BY request_date DESC")
+    rows = await db_router.read(read_page, user_id)
 
-async def get_all_users():
-    """Получение всех пользователей"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM users ORDER BY registration_date DESC")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
 
-async def get_all_services():
+async def get_all_services(user_id: int = None):
     """Получение всех услуг"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM services")
+    return await db_router.read(lambda conn: conn.fetch("SELECT * FROM services"), user_id)
 
-async def get_all_faq():
+async def get_all_faq(user_id: int = None):
     """Получение всех вопросов FAQ"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM faq")
-
-async def clear_all_requests():
-    """Очистка всех заявок из базы данных"""
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM requests")
-        logger.info("Все заявки удалены из базы данных")
-
+    return await db_router.read(lambda conn: conn.fetch("SELECT * FROM faq"), user_id)
 
 async def register_user(user_id: int, username: str, full_name: str):
-    """Регистрация/обновление пользователя"""
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO users (user_id, username, full_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET last_activity = NOW(), username = EXCLUDED.username, full_name = EXCLUDED.full_name
-        ''', user_id, username, full_name)
-    logger.info(f"Пользователь {user_id} зарегистрирован/обновлен")
-
-async def create_request(user_id: int, request_text: str, service_option_id: int = None):
-    """Создание новой заявки"""
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO requests (user_id, request_text, service_option_id)
-            VALUES ($1, $2, $3)
-        ''', user_id, request_text, service_option_id)
-        request_id = await conn.fetchval("SELECT lastval()")
-    return request_id
-
-async def get_services():
-    """Получение списка услуг"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM services")
+    """Регистрация/обновление пользователя (запись в БД выполняется пакетно в фоне)"""
+    user_activity.add(user_id, username, full_name)
+    db_router.mark_write(user_id)
+
+async def create_request(user_id: int, request_text: str, service_option_id: int = None,
+                         message_id: int = None):
+    """Создание новой заявки.
+
+    С message_id повторная заявка из того же сообщения не создается и
+    возвращается None. Если БД недоступна или журнал еще не перенесен в БД,
+    заявка записывается в локальный журнал и возвращается REQUEST_SPOOLED.
+    """
+    # Пользователь из буфера должен попасть в БД раньше заявки, ссылающейся на него
+    await user_activity.ensure_flushed(user_id)
+    db_router.mark_write(user_id)
+    row = (user_id, request_text, service_option_id, message_id)
+    if request_spool.size:
+        await request_spool.append_requests([row])
+        return REQUEST_SPOOLED
+    try:
+        async with db_pool.acquire() as conn:
+            return await conn.statements["create_request"].fetchval(*row)
+    except DB_UNAVAILABLE_ERRORS as e:
+        await spool_requests([row], e)
+        return REQUEST_SPOOLED
+
+async def create_requests(rows: list):
+    """Создание нескольких заявок одним запросом.
+
+    rows - список кортежей (user_id, request_text, service_option_id, message_id).
+    Номера заявок выделяются из последовательности заранее, поэтому
+    возвращаются строго в порядке rows; для повторов (user_id, message_id)
+    вместо номера возвращается None. Если БД недоступна, заявки записываются
+    в локальный журнал и для каждой возвращается REQUEST_SPOOLED; так же,
+    пока журнал не перенесен в БД, чтобы записи не обгоняли его.
+    """
+    for user_id in {row[0] for row in rows}:
+        await user_activity.ensure_flushed(user_id)
+        db_router.mark_write(user_id)
+    if request_spool.size:
+        # Пользователь может пока быть только в журнале, и прямая запись нарушила бы внешний ключ
+        await request_spool.append_requests(rows)
+        return [REQUEST_SPOOLED] * len(rows)
+    try:
+        async with db_pool.acquire() as conn:
+            records = await conn.statements["create_requests"].fetch(
+                [row[0] for row in rows],
+                [row[1] for row in rows],
+                [row[2] for row in rows],
+                [row[3] for row in rows],
+                [None] * len(rows)
+            )
+    except DB_UNAVAILABLE_ERRORS as e:
+        await spool_requests(rows, e)
+        return [REQUEST_SPOOLED] * len(rows)
+    return [record["request_id"] for record in records]
+
+# ================== ОТЛОЖЕННАЯ ЗАПИСЬ ПОЛЬЗОВАТЕЛЕЙ ==================
+
+# Отдельный логгер для частых сообщений о записи, см. LOGGING_CONFIG["sampling"]
+activity_logger = logger.getChild("activity")
+
+class UserActivityBuffer:
+    """Буфер регистраций и обновлений last_activity.
+
+    Повторные события одного пользователя схлопываются, а накопленные строки
+    записываются одним INSERT ... ON CONFLICT по массивам через unnest.
+    """
+
+    def __init__(self, interval: float, max_rows: int):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._pending = {}    # user_id -> (username, full_name)
+        self._flushing = {}   # строки, которые сейчас записываются
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._pool = None
+        self._task = None
+
+    def add(self, user_id: int, username: str, full_name: str):
+        self._pending[user_id] = (username, full_name)
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+
+    async def ensure_flushed(self, user_id: int):
+        """Дождаться записи пользователя в БД, если он еще в буфере"""
+        if user_id in self._pending or user_id in self._flushing:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                if request_spool.size:
+                    # Журнал еще не перенесен в БД: пишем за ним, чтобы не нарушить порядок записей
+                    await self._spool()
+                    return
+                async with self._pool.acquire() as conn:
+                    await conn.statements["upsert_users"].fetch(
+                        list(self._flushing),
+                        [username for username, _ in self._flushing.values()],
+                        [full_name for _, full_name in self._flushing.values()]
+                    )
+            except DB_UNAVAILABLE_ERRORS as e:
+                # БД недоступна: регистрации сохраняются в локальный журнал и будут перенесены позже
+                await self._spool()
+                logger.warning("БД недоступна (%s), пользователей записано в журнал: %s", e, len(self._flushing))
+            except Exception:
+                self._restore()
+                raise
+            else:
+                activity_logger.info("Записано пользователей: %s", len(self._flushing))
+            finally:
+                self._flushing = {}
+
+    async def _spool(self):
+        try:
+            await request_spool.append_users(
+                [(user_id, username, full_name) for user_id, (username, full_name) in self._flushing.items()]
+            )
+        except Exception:
+            self._restore()
+            raise
+
+    def _restore(self):
+        # Возвращаем строки в буфер, не затирая более свежие данные
+        for user_id, row in self._flushing.items():
+            self._pending.setdefault(user_id, row)
+
+    def start(self, pool: asyncpg.pool.Pool):
+        self._pool = pool
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка фоновой записи и сброс оставшихся строк"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи активности пользователей: %s", e)
+
+user_activity = UserActivityBuffer(USER_ACTIVITY_FLUSH_INTERVAL, USER_ACTIVITY_FLUSH_ROWS)
+
+# ================== ПАКЕТНОЕ СОЗДАНИЕ ЗАЯВОК ==================
+
+class RequestBatcher:
+    """Объединение одновременно создаваемых заявок в один INSERT.
+
+    Первая заявка в пакете запускает таймер на window секунд; все заявки,
+    пришедшие за это время (но не больше max_size), записываются вместе,
+    и каждый вызов submit получает свой номер заявки.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._batch = []
+        self._timer = None
+        self._writes = set()
+
+    async def submit(self, user_id: int, request_text: str, service_option_id: int = None,
+                     message_id: int = None):
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append(((user_id, request_text, service_option_id, message_id), future))
+        if len(self._batch) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: list):
+        try:
+            request_ids = await create_requests([row for row, _ in batch])
+        except Exception as e:
+            if len(batch) > 1 and not isinstance(e, DB_UNAVAILABLE_ERRORS):
+                # Ошибка одной строки (например, заявка удаленного пользователя) не должна
+                # отменять заявки остальных: повторяем запись по одной
+                logger.warning("Ошибка записи пакета из %s заявок, записываем по одной: %s", len(batch), e)
+                for item in batch:
+                    await self._write([item])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), request_id in zip(batch, request_ids):
+                if not future.done():
+                    future.set_result(request_id)
+
+    async def stop(self):
+        """Запись накопленного пакета и ожидание незавершенных вставок"""
+        self._flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+request_batcher = RequestBatcher(REQUEST_BATCH_WINDOW, REQUEST_BATCH_MAX_SIZE)
+
+# ================== РАБОТА ПРИ НЕДОСТУПНОЙ БД ==================
+
+class DatabaseUnavailableError(Exception):
+    """Цепь к основной БД разомкнута: запрос отклонен без обращения к пулу"""
+
+# Ошибки, говорящие о недоступности БД, а не об ошибке в самом запросе
+DB_UNAVAILABLE_ERRORS = (*REPLICA_ERRORS, asyncpg.QueryCanceledError, DatabaseUnavailableError)
+
+# Номер заявки, которая записана в локальный журнал и получит настоящий номер при переносе в БД
+REQUEST_SPOOLED = object()
+
+class CircuitBreaker:
+    """Предохранитель для обращений к основной БД.
+
+    Если за window секунд доля ошибок соединения и таймаутов достигает
+    failure_threshold (при не менее min_calls вызовах), цепь размыкается и
+    захват соединения сразу завершается DatabaseUnavailableError. Через
+    reset_timeout пропускается один пробный вызов: успех замыкает цепь,
+    ошибка снова размыкает ее.
+    """
+
+    def __init__(self, failure_threshold: float, min_calls: int, window: float, reset_timeout: float,
+                 acquire_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.acquire_timeout = acquire_timeout
+        self.state = "closed"  # closed, open или half_open
+        self._calls = deque()  # (время, успех) за последние window секунд
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self):
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise DatabaseUnavailableError("цепь к БД разомкнута")
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self._probe_in_flight:
+            raise DatabaseUnavailableError("ожидается результат пробного запроса к БД")
+        self._probe_in_flight = True
+
+    def record(self, ok: bool):
+        if self.state == "half_open":
+            self._probe_in_flight = False
+            if ok:
+                self._close()
+            else:
+                self._open()
+            return
+        if self.state == "open":
+            # Вызов начался до размыкания цепи
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, ok))
+        self._failures += not ok
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, old_ok = self._calls.popleft()
+            self._failures -= not old_ok
+        if len(self._calls) >= self.min_calls and self._failures / len(self._calls) >= self.failure_threshold:
+            self._open()
+
+    def cancel_probe(self):
+        """Пробный вызов отменен, не дождавшись ответа БД"""
+        if self.state == "half_open":
+            self._probe_in_flight = False
+
+    def _open(self):
+        if self.state != "open":
+            logger.error("Цепь к БД разомкнута: запросы отклоняются, записи идут в локальный журнал")
+        self.state = "open"
+        self._opened_at = time.monotonic()
+
+    def _close(self):
+        logger.info("Цепь к БД замкнута")
+        self.state = "closed"
+        self._calls.clear()
+        self._failures = 0
+
+db_breaker = CircuitBreaker(**CIRCUIT_BREAKER_CONFIG)
+
+class RequestSpool:
+    """Локальный журнал заявок и регистраций на время недоступности БД.
+
+    Записи добавляются в файл SQLite (только добавление, WAL, synchronous=FULL)
+    в отдельном потоке и переносятся в PostgreSQL пакетами по replay_batch в
+    порядке поступления, как только цепь к БД замкнута. Пакет переносится в
+    одной транзакции и удаляется из журнала после ее фиксации; повтор заявок
+    с message_id после сбоя между этими шагами отсекает request_keys. Если
+    пакет отклонен не из-за недоступности БД, записи переносятся по одной, а
+    отклоненные откладываются в таблицу rejected и в лог.
+    """
+
+    def __init__(self, path: str, replay_batch: int, replay_interval: float):
+        self.path = path
+        self.replay_batch = replay_batch
+        self.replay_interval = replay_interval
+        self.size = 0
+        # Все операции с SQLite выполняются в одном потоке
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self._db = None
+        self._task = None
+        self._replay_lock = asyncio.Lock()  # один перенос за раз, иначе пакеты запишутся дважды
+        # Забирать ли журналы без владельца (см. orphaned_spool_paths); при WORKERS > 1 - только воркер 0
+        self.adopt_orphans = True
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self) -> int:
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL
+            )
+        ''')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS rejected (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                error TEXT NOT NULL
+            )
+        ''')
+        return self._db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+    def _adopt(self, paths: list) -> int:
+        """Перенос записей чужих журналов в конец своего с удалением их файлов"""
+        adopted = 0
+        for path in paths:
+            other = sqlite3.connect(path)
+            try:
+                tables = {name for name, in other.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                journal, rejected = [], []
+                if "journal" in tables:
+                    journal = other.execute("SELECT kind, payload FROM journal ORDER BY id").fetchall()
+                if "rejected" in tables:
+                    rejected = other.execute("SELECT kind, payload, error FROM rejected ORDER BY id").fetchall()
+            finally:
+                other.close()
+            with self._db:
+                self._db.executemany("INSERT INTO journal (kind, payload) VALUES (?, ?)", journal)
+                self._db.executemany("INSERT INTO rejected (kind, payload, error) VALUES (?, ?, ?)", rejected)
+            for suffix in ("", "-wal", "-shm"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path + suffix)
+            logger.warning("Журнал %s без владельца перенесен в %s: записей %s", path, self.path, len(journal))
+            adopted += len(journal)
+        return adopted
+
+    def _append(self, kind: str, payloads: list):
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO journal (kind, payload) VALUES (?, ?)",
+                [(kind, json.dumps(payload, ensure_ascii=False)) for payload in payloads]
+            )
 
-async def get_service_options(service_id: int):
-    """Получение вариантов для услуги"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch('''
-            SELECT * FROM service_options 
-            WHERE service_id = $1
-        ''', service_id)
+    def _read_batch(self) -> list:
+        return self._db.execute(
+            "SELECT id, kind, payload FROM journal ORDER BY id LIMIT ?", (self.replay_batch,)
+        ).fetchall()
 
-async def get_faq_questions():
-    """Получение списка вопросов FAQ"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT question FROM faq")
+    def _delete_through(self, last_id: int) -> int:
+        with self._db:
+            return self._db.execute("DELETE FROM journal WHERE id <= ?", (last_id,)).rowcount
 
-async def get_faq_answer(question: str):
-    """Получение ответа на вопрос FAQ"""
-    async with db_pool.acquire() as conn:
-        return await conn.fetchval('''
-            SELECT answer FROM faq 
-            WHERE question = $1
-        ''', question)
+    def _reject(self, entry_id: int, error: str) -> int:
+        with self._db:
+            self._db.execute(
+                "INSERT INTO rejected (id, kind, payload, error) SELECT id, kind, payload, ? FROM journal WHERE id = ?",
+                (error, entry_id)
+            )
+            return self._db.execute("DELETE FROM journal WHERE id = ?", (entry_id,)).rowcount
+
+    async def _add(self, kind: str, payloads: list):
+        # Размер увеличивается до записи: пока она идет, новые записи тоже должны идти в журнал
+        self.size += len(payloads)
+        try:
+            await self._call(self._append, kind, payloads)
+        except Exception:
+            self.size -= len(payloads)
+            raise
+
+    async def append_users(self, rows: list):
+        """rows - кортежи (user_id, username, full_name)"""
+        await self._add("user", [list(row) for row in rows])
+
+    async def append_requests(self, rows: list):
+        """rows - кортежи (user_id, request_text, service_option_id, message_id)"""
+        created = datetime.now().isoformat()
+        await self._add("request", [[*row, created] for row in rows])
+
+    async def _write(self, conn, entries: list):
+        """Запись в БД одной транзакцией; entries - (id, вид, данные) в порядке журнала"""
+        # Повторные регистрации пользователя схлопываются: ON CONFLICT DO UPDATE
+        # не может изменить одну строку дважды за команду
+        users = {row[0]: row for _, kind, row in entries if kind == "user"}
+        requests = [row for _, kind, row in entries if kind == "request"]
+        async with conn.transaction():
+            # Пользователи раньше заявок: заявки ссылаются на них внешним ключом
+            if users:
+                await conn.statements["upsert_users"].fetch(*map(list, zip(*users.values())))
+            if requests:
+                await conn.statements["create_requests"].fetch(
+                    *map(list, zip(*(row[:4] for row in requests))),
+                    [datetime.fromisoformat(row[4]) for row in requests]
+                )
+
+    async def _write_one_by_one(self, conn, entries: list):
+        for entry in entries:
+            try:
+                await self._write(conn, [entry])
+            except DB_UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                logger.error("Запись журнала %s отклонена БД и отложена: %s", entry[0], e)
+                self.size = max(0, self.size - await self._call(self._reject, entry[0], str(e)))
+            else:
+                self.size = max(0, self.size - await self._call(self._delete_through, entry[0]))
+
+    async def replay(self):
+        """Перенос всего журнала в БД"""
+        async with self._replay_lock:
+            await self._replay()
+
+    async def _replay(self):
+        while True:
+            batch = await self._call(self._read_batch)
+            if not batch:
+                return
+            entries = [(entry_id, kind, json.loads(payload)) for entry_id, kind, payload in batch]
+
+            async with db_pool.acquire() as conn:
+                try:
+                    await self._write(conn, entries)
+                except DB_UNAVAILABLE_ERRORS:
+                    raise
+                except Exception as e:
+                    logger.warning("Пакет журнала отклонен БД, переносим записи по одной: %s", e)
+                    await self._write_one_by_one(conn, entries)
+                    continue
+            self.size = max(0, self.size - await self._call(self._delete_through, batch[-1][0]))
+            logger.info("Из журнала перенесено в БД записей: %s", len(batch))
+
+    async def start(self):
+        self.size = await self._call(self._open)
+        if self.adopt_orphans:
+            orphans = orphaned_spool_paths()
+            if orphans:
+                self.size += await self._call(self._adopt, orphans)
+        if self.size:
+            logger.warning("В локальном журнале %s записей, переносим в БД", self.size)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if self.size and db_breaker.state != "open":
+                try:
+                    await self.replay()
+                except Exception as e:
+                    logger.error("Ошибка переноса журнала в БД: %s", e)
+            await asyncio.sleep(self.replay_interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._db is not None:
+            await self._call(self._db.close)
+        self._executor.shutdown(wait=True)
+
+request_spool = RequestSpool(**SPOOL_CONFIG)
+
+SPOOL_WORKER_SUFFIX_RE = re.compile(r"\.worker\d+")
+
+def orphaned_spool_paths() -> list:
+    """Журналы, которые при текущем WORKERS никто не переносит в БД.
+
+    Однопроцессный режим пишет в SPOOL_CONFIG["path"], воркер N - в path.workerN;
+    после смены WORKERS остаются файлы без процесса-владельца.
+    """
+    base = SPOOL_CONFIG["path"]
+    owned = {base} if WORKERS == 1 else {f"{base}.worker{index}" for index in range(WORKERS)}
+    candidates = [base] + [
+        path for path in glob.glob(glob.escape(base) + ".worker*")
+        if SPOOL_WORKER_SUFFIX_RE.fullmatch(path[len(base):])
+    ]
+    return sorted(path for path in candidates if path not in owned and os.path.exists(path))
+
+async def spool_requests(rows: list, error: Exception):
+    logger.warning("БД недоступна (%s), заявок записано в журнал: %s", error, len(rows))
+    await request_spool.append_requests(rows)
+
+# ================== НЕЧЕТКИЙ ПОИСК ПО FAQ ==================
+
+NON_WORD_RE = re.compile(r"[^\w\s]+")
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр, ё -> е, без знаков препинания и лишних пробелов"""
+    return " ".join(NON_WORD_RE.sub(" ", text.lower().replace("ё", "е")).split())
+
+def text_trigrams(text: str) -> dict:
+    """Частоты символьных триграмм по словам текста"""
+    counts = {}
+    for word in normalize_text(text).split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            trigram = padded[i:i + 3]
+            counts[trigram] = counts.get(trigram, 0) + 1
+    return counts
+
+class FaqMatcher:
+    """Поиск вопроса FAQ, похожего на произвольный текст.
+
+    Вопросы представлены векторами TF-IDF по символьным триграммам, поэтому
+    совпадение устойчиво к опечаткам, окончаниям и порядку слов. Инвертированный
+    индекс триграмма -> вопросы строится один раз при загрузке каталога, и поиск
+    затрагивает только вопросы с общими триграммами.
+    """
+
+    def __init__(self, faq: dict):
+        self.questions = list(faq)
+        self.answers = [faq[question] for question in self.questions]
+        documents = [text_trigrams(question) for question in self.questions]
+
+        document_frequency = {}
+        for trigrams in documents:
+            for trigram in trigrams:
+                document_frequency[trigram] = document_frequency.get(trigram, 0) + 1
+        self.idf = {
+            trigram: math.log(1 + len(documents) / frequency)
+            for trigram, frequency in document_frequency.items()
+        }
+
+        self.index = {}  # триграмма -> [(номер вопроса, вес)]
+        self.norms = []
+        for number, trigrams in enumerate(documents):
+            weights = {trigram: count * self.idf[trigram] for trigram, count in trigrams.items()}
+            for trigram, weight in weights.items():
+                self.index.setdefault(trigram, []).append((number, weight))
+            self.norms.append(math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0)
+
+    def match(self, text: str, threshold: float = FAQ_MATCH_THRESHOLD, coverage: float = FAQ_MATCH_COVERAGE):
+        """Лучший вопрос и ответ с косинусной близостью не ниже threshold, иначе None.
+
+        Кроме того, вопрос должен покрывать не меньше coverage веса триграмм
+        текста: ложное совпадение теряет заявку, а пропущенное стоит лишь
+        лишней строки в requests.
+        """
+        trigrams = text_trigrams(text)
+        scores = {}
+        covered = {}  # номер вопроса -> вес общих с текстом триграмм
+        query_norm = 0.0
+        query_weight = 0.0
+        for trigram, count in trigrams.items():
+            # Триграммы, которых нет ни в одном вопросе, учитываются с наибольшим весом
+            weight = count * self.idf.get(trigram, math.log(1 + len(self.questions)))
+            query_norm += weight * weight
+            query_weight += weight
+            for number, document_weight in self.index.get(trigram, ()):
+                scores[number] = scores.get(number, 0.0) + weight * document_weight
+                covered[number] = covered.get(number, 0.0) + weight
+        if not scores:
+            return None
+
+        query_norm = math.sqrt(query_norm)
+        number, score = max(
+            ((number, score / (query_norm * self.norms[number])) for number, score in scores.items()),
+            key=lambda item: item[1]
+        )
+        if score < threshold or covered[number] < coverage * query_weight:
+            return None
+        return self.questions[number], self.answers[number]
+
+# ================== КЭШ КАТАЛОГА ==================
+
+CATALOG_CHANNEL = "catalog_changed"
+
+class Catalog:
+    """Кэш услуг, вариантов услуг и FAQ в памяти.
+
+    Меню и поиск по тексту сообщений работают только со словарями ниже и не
+    обращаются к пулу. Каталог перечитывается целиком после удаления услуг и
+    вопросов FAQ, а также по сигналу NOTIFY от триггеров на таблицах каталога.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.services = {}            # название услуги -> запись
+        self.services_by_id = {}      # service_id -> запись
+        self.options = {}             # название варианта -> запись с service_name
+        self.options_by_service = {}  # service_id -> список вариантов
+        self.faq = {}                 # вопрос -> ответ
+        self.faq_questions = []
+        self.faq_matcher = FaqMatcher({})
+        self.loaded = asyncio.Event()  # установлен после первой загрузки
+        self._lock = asyncio.Lock()
+        self._dirty = False
+        self._reload_task = None
+
+    async def load(self, pool: asyncpg.pool.Pool):
+        """Полная перезагрузка каталога из БД"""
+        async with self._lock:
+            # Каталог читается из основной БД: после NOTIFY реплика может еще не содержать изменений
+            async with pool.acquire() as conn:
+                services = await conn.statements["catalog_services"].fetch()
+                options = await conn.statements["catalog_options"].fetch()
+                faqs = await conn.statements["catalog_faq"].fetch()
+
+            options_by_service = {}
+            options_by_name = {}
+            for option in options:
+                options_by_service.setdefault(option["service_id"], []).append(option)
+                options_by_name.setdefault(option["name"], option)
+
+            # Подменяем индексы целиком, чтобы обработчики не видели частично собранный каталог
+            self.services = {s["name"]: s for s in services}
+            self.services_by_id = {s["service_id"]: s for s in services}
+            self.options = options_by_name
+            self.options_by_service = options_by_service
+            self.faq = {f["question"]: f["answer"] for f in faqs}
+            self.faq_questions = [{"question": f["question"]} for f in faqs]
+            self.faq_matcher = FaqMatcher(self.faq)
+            self.version += 1
+            self.loaded.set()
+        logger.info(
+            "Каталог загружен (версия %s): услуг %s, вариантов %s, вопросов FAQ %s",
+            self.version, len(services), len(options), len(faqs)
+        )
+
+    def schedule_reload(self, pool: asyncpg.pool.Pool):
+        """Фоновая перезагрузка; сигналы, пришедшие во время загрузки, объединяются"""
+        self._dirty = True
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload_loop(pool))
+
+    async def _reload_loop(self, pool: asyncpg.pool.Pool):
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self.load(pool)
+            except Exception as e:
+                logger.error("Ошибка перезагрузки каталога: %s", e)
+                return
+
+catalog = Catalog()
+
+def on_catalog_notify(conn, pid, channel, payload):
+    """Обработчик NOTIFY от триггеров на таблицах каталога"""
+    catalog.schedule_reload(db_pool)
+
+def on_catalog_listener_lost(conn):
+    """Переподключение слушателя при обрыве соединения"""
+    logger.error("Соединение LISTEN для каталога потеряно, переподключаемся")
+    asyncio.get_running_loop().create_task(start_catalog_listener())
+
+async def start_catalog_listener():
+    """Подписка на изменения каталога через LISTEN/NOTIFY"""
+    global catalog_listener
+    while True:
+        try:
+            catalog_listener = await asyncpg.connect(**DB_CONFIG)
+            break
+        except Exception as e:
+            logger.error("Не удалось подключить слушателя каталога: %s", e)
+            await asyncio.sleep(5)
+    await catalog_listener.add_listener(CATALOG_CHANNEL, on_catalog_notify)
+    catalog_listener.add_termination_listener(on_catalog_listener_lost)
+    # Изменения могли произойти, пока слушатель был отключен
+    catalog.schedule_reload(db_pool)
+
+async def stop_catalog_listener():
+    if catalog_listener is not None and not catalog_listener.is_closed():
+        catalog_listener.remove_termination_listener(on_catalog_listener_lost)
+        await catalog_listener.close()
+
+# ================== КЭШ МЕДИАФАЙЛОВ ==================
+
+class MediaCache:
+    """file_id медиафайлов, уже загруженных в Telegram.
+
+    Первая отправка идет по URL, и Telegram сам скачивает файл; полученный
+    file_id сохраняется в памяти и в БД, поэтому следующие отправки - один
+    быстрый вызов API без повторной загрузки. Если file_id перестал быть
+    действительным, файл автоматически загружается заново.
+    """
+
+    def __init__(self):
+        self._file_ids = {}
+
+    async def load(self):
+        rows = await db_router.read(lambda conn: conn.statements["media_all"].fetch())
+        # Загрузка идет в фоне, и file_id, полученные за это время, новее сохраненных
+        for row in rows:
+            self._file_ids.setdefault(row["media_key"], row["file_id"])
+
+    async def _save(self, key: str, file_id: str):
+        self._file_ids[key] = file_id
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.statements["media_save"].fetch(key, file_id)
+        except Exception as e:
+            logger.error("Не удалось сохранить file_id для %s: %s", key, e)
+
+    async def _forget(self, key: str):
+        self._file_ids.pop(key, None)
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.statements["media_delete"].fetch(key)
+        except Exception as e:
+            logger.error("Не удалось удалить file_id для %s: %s", key, e)
+
+    async def send_photo(self, chat_id: int, key: str, **kwargs) -> types.Message:
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logger.warning("file_id для %s недействителен, загружаем заново: %s", key, e)
+                await self._forget(key)
+
+        sent = await bot.send_photo(chat_id, photo=MEDIA[key], **kwargs)
+        await self._save(key, sent.photo[-1].file_id)
+        return sent
+
+    async def prewarm(self, chat_id: int):
+        """Загрузка в Telegram всех медиафайлов, для которых еще нет file_id"""
+        for key in MEDIA:
+            if key in self._file_ids:
+                continue
+            try:
+                sent = await self.send_photo(chat_id, key, disable_notification=True)
+                await bot.delete_message(chat_id, sent.message_id)
+            except Exception as e:
+                logger.error("Не удалось загрузить %s при старте: %s", key, e)
+
+media_cache = MediaCache()
 
 # ================== КЛАВИАТУРЫ ==================
 
-def get_main_kb():
+class KeyboardRegistry:
+    """Кэш собранных клавиатур.
+
+    Каждая клавиатура строится один раз. Клавиатуры, зависящие от каталога,
+    хранятся отдельно и сбрасываются при смене версии каталога.
+    """
+
+    def __init__(self):
+        self._static = {}
+        self._dynamic = {}
+        self._catalog_version = None
+
+    def get(self, key, build, dynamic: bool = False):
+        if dynamic:
+            if self._catalog_version != catalog.version:
+                self._dynamic.clear()
+                self._catalog_version = catalog.version
+            cache = self._dynamic
+        else:
+            cache = self._static
+        markup = cache.get(key)
+        if markup is None:
+            markup = cache[key] = build()
+        return markup
+
+keyboards = KeyboardRegistry()
+
+def build_main_kb():
     builder = ReplyKeyboardBuilder()
     builder.row(
         KeyboardButton(text="🚨 IT-Аутсорсинг"),
@@ -297,13 +2254,13 @@ def get_main_kb():
     )
     return builder.as_markup(resize_keyboard=True)
 
-def get_back_kb():
+def build_back_kb():
     return ReplyKeyboardMarkup(
         keyboard=[[KeyboardButton(text="🔙 Назад")]],
         resize_keyboard=True
     )
 
-def get_outsource_kb():
+def build_outsource_kb():
     builder = ReplyKeyboardBuilder()
     builder.row(
         KeyboardButton(text="🌐 Веб-разработка"),
@@ -314,9 +2271,9 @@ def get_outsource_kb():
     )
     return builder.as_markup(resize_keyboard=True)
 
-def get_help_kb():
+def build_help_kb():
     builder = ReplyKeyboardBuilder()
-    questions = dp["faq_questions"]  # Заполняется при старте
+    questions = catalog.faq_questions  # Заполняется при старте
     for question in questions[:2]:
         builder.add(KeyboardButton(text=question["question"]))
     builder.row(
@@ -326,6 +2283,29 @@ def get_help_kb():
     builder.adjust(2)
     return builder.as_markup(resize_keyboard=True)
 
+def build_service_kb(service_id: int):
+    builder = ReplyKeyboardBuilder()
+    for option in catalog.options_by_service.get(service_id, []):
+        builder.add(KeyboardButton(text=option["name"]))
+    builder.add(KeyboardButton(text="🔙 Назад"))
+    builder.adjust(1)
+    return builder.as_markup(resize_keyboard=True)
+
+def get_main_kb():
+    return keyboards.get("main", build_main_kb)
+
+def get_back_kb():
+    return keyboards.get("back", build_back_kb)
+
+def get_outsource_kb():
+    return keyboards.get("outsource", build_outsource_kb)
+
+def get_help_kb():
+    return keyboards.get("help", build_help_kb, dynamic=True)
+
+def get_service_kb(service_id: int):
+    return keyboards.get(("service", service_id), lambda: build_service_kb(service_id), dynamic=True)
+
 
 ADMIN_IDS = {}  # Замените на реальные ID администраторов
 
@@ -344,60 +2324,109 @@ async def admin_panel(message: types.Message):
         "/requests - Просмотр всех заявок\n"
         "/users - Просмотр всех пользователей\n"
         "/services - Просмотр всех услуг\n"
-        "/faq - Просмотр всех вопросов FAQ\n\n"
-        "Для удаления используйте:\n"
-        "/delete_request [id] - Удалить заявку\n"
-        "/delete_user [id] - Удалить пользователя\n"
-        "/delete_service [id] - Удалить услугу\n"
-        "/delete_faq [id] - Удалить вопрос FAQ\n\n"
-        "/clear_requests - Очистить все заявки"
+        "/faq - Просмотр всех вопросов FAQ\n"
+        "/stats - Статистика заявок и пользователей\n\n"
+        "Для удаления используйте (номера через пробел или запятую, диапазоны 10-20):\n"
+        "/delete_request [id ...] [user=id] [status=...] [before=ГГГГ-ММ-ДД] - Удалить заявки\n"
+        "/delete_user [id ...] [before=ГГГГ-ММ-ДД] - Удалить пользователей\n"
+        "/delete_service [id ...] - Удалить услуги\n"
+        "/delete_faq [id ...] - Удалить вопросы FAQ\n\n"
+        "/clear_requests - Очистить все заявки\n\n"
+        "/broadcast [текст] - Рассылка всем пользователям\n"
+        "/broadcast_cancel [id] - Остановить рассылку\n\n"
+        "/export requests|users [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [status=...] [format=xlsx] - Выгрузка в файл"
     )
     await message.answer(text, parse_mode="HTML")
 
+def render_request(req) -> str:
+    return (
+        f"ID: {req['request_id']}\n"
+        f"Пользователь: {req['user_id']}\n"
+        f"Дата: {req['request_date'].strftime('%Y-%m-%d %H:%M')}\n"
+        f"Статус: {html.escape(req['status'])}\n"
+        f"Текст: {html.escape(req['request_text'])}...\n\n"
+    )
+
+def render_user(user) -> str:
+    return (
+        f"ID: {user['user_id']}\n"
+        f"Имя: {html.escape(user['full_name'])}\n"
+        f"Username: @{user['username']}\n"
+        f"Дата регистрации: {user['registration_date'].strftime('%Y-%m-%d')}\n\n"
+    )
+
+ADMIN_PAGES = {
+    "requests": ("📋 <b>Список заявок:</b>\n\n", "Нет заявок в базе данных", render_request),
+    "users": ("👥 <b>Список пользователей:</b>\n\n", "Нет пользователей в базе данных", render_user),
+}
+
+async def build_admin_page(listing: str, cursor: tuple = None, backward: bool = False, user_id: int = None):
+    """Текст и кнопки навигации для страницы списка"""
+    rows, has_more = await get_listing_page(listing, cursor, backward, user_id=user_id)
+    title, empty_text, render = ADMIN_PAGES[listing]
+    if not rows:
+        return empty_text, None
+
+    # Страница собирается через join, а не через += в цикле
+    text = title + "".join(render(row) for row in rows)
+
+    cfg = ADMIN_LISTINGS[listing]
+    has_newer = has_more if backward else cursor is not None
+    has_older = cursor is not None if backward else has_more
+    builder = InlineKeyboardBuilder()
+    if has_newer:
+        first = rows[0]
+        builder.button(
+            text="⬅️ Предыдущие",
+            callback_data=f"page:{listing}:n:{first[cfg['id']]}:{first[cfg['date']].isoformat()}"
+        )
+    if has_older:
+        last = rows[-1]
+        builder.button(
+            text="Следующие ➡️",
+            callback_data=f"page:{listing}:o:{last[cfg['id']]}:{last[cfg['date']].isoformat()}"
+        )
+    return text, builder.as_markup() if has_newer or has_older else None
+
 @dp.message(Command("requests"))
 async def show_requests(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
-    requests = await get_all_requests()
-    if not requests:
-        await message.answer("Нет заявок в базе данных")
-        return
-    
-    text = "📋 <b>Список заявок:</b>\n\n"
-    for req in requests:
-        text += (
-            f"ID: {req['request_id']}\n"
-            f"Пользователь: {req['user_id']}\n"
-            f"Дата: {req['request_date'].strftime('%Y-%m-%d %H:%M')}\n"
-            f"Статус: {req['status']}\n"
-            f"Текст: {req['request_text'][:50]}...\n\n"
-        )
-    
-    await message.answer(text, parse_mode="HTML")
+
+    text, markup = await build_admin_page("requests", user_id=message.from_user.id)
+    await message.answer(text, parse_mode="HTML", reply_markup=markup)
 
 @dp.message(Command("users"))
 async def show_users(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
-    users = await get_all_users()
-    if not users:
-        await message.answer("Нет пользователей в базе данных")
+
+    text, markup = await build_admin_page("users", user_id=message.from_user.id)
+    await message.answer(text, parse_mode="HTML", reply_markup=markup)
+
+@dp.callback_query(F.data.startswith("page:"))
+async def admin_page_callback(callback: types.CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("⛔ У вас нет прав администратора", show_alert=True)
         return
-    
-    text = "👥 <b>Список пользователей:</b>\n\n"
-    for user in users:
-        text += (
-            f"ID: {user['user_id']}\n"
-            f"Имя: {user['full_name']}\n"
-            f"Username: @{user['username']}\n"
-            f"Дата регистрации: {user['registration_date'].strftime('%Y-%m-%d')}\n\n"
-        )
-    
-    await message.answer(text, parse_mode="HTML")
+
+    try:
+        _, listing, direction, row_id, row_date = callback.data.split(":", 4)
+        cursor = (datetime.fromisoformat(row_date), int(row_id))
+    except ValueError:
+        await callback.answer("❌ Некорректная страница")
+        return
+    if listing not in ADMIN_PAGES:
+        await callback.answer("❌ Некорректная страница")
+        return
+
+    text, markup = await build_admin_page(
+        listing, cursor, backward=direction == "n", user_id=callback.from_user.id
+    )
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    await callback.answer()
 
 @dp.message(Command("services"))
 async def show_services(message: types.Message):
@@ -405,7 +2434,7 @@ async def show_services(message: types.Message):
         await message.answer("⛔ У вас нет прав администратора")
         return
     
-    services = await get_all_services()
+    services = await get_all_services(message.from_user.id)
     if not services:
         await message.answer("Нет услуг в базе данных")
         return
@@ -426,7 +2455,7 @@ async def show_faq(message: types.Message):
         await message.answer("⛔ У вас нет прав администратора")
         return
     
-    faqs = await get_all_faq()
+    faqs = await get_all_faq(message.from_user.id)
     if not faqs:
         await message.answer("Нет вопросов в FAQ")
         return
@@ -441,83 +2470,881 @@ async def show_faq(message: types.Message):
     
     await message.answer(text, parse_mode="HTML")
 
-@dp.message(Command("delete_request"))
-async def delete_request_cmd(message: types.Message):
+async def get_stats(user_id: int = None) -> dict:
+    """Сводки для /stats за последние STATS_DAYS дней"""
+    async def read_stats(conn):
+        return {
+            "by_day": await conn.statements["stats_requests_by_day"].fetch(STATS_DAYS),
+            "by_status": await conn.statements["stats_requests_by_status"].fetch(),
+            "top_options": await conn.statements["stats_top_options"].fetch(STATS_DAYS, STATS_TOP_OPTIONS),
+            "users": await conn.statements["stats_users"].fetchrow(STATS_DAYS),
+        }
+
+    return await db_router.read(read_stats, user_id)
+
+@dp.message(Command("stats"))
+async def show_stats(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
-    try:
-        request_id = int(message.text.split()[1])
-    except (IndexError, ValueError):
-        await message.answer("❌ Использование: /delete_request [id]")
-        return
-    
-    if await delete_request(request_id):
-        await message.answer(f"✅ Заявка #{request_id} удалена")
-    else:
-        await message.answer("❌ Заявка не найдена")
 
-@dp.message(Command("delete_user"))
-async def delete_user_cmd(message: types.Message):
+    stats = await get_stats(message.from_user.id)
+    users = stats["users"]
+    lines = [
+        "📊 <b>Статистика</b>\n",
+        "<b>Пользователи:</b>",
+        f"Всего: {users['total']}",
+        f"Новых сегодня / за {STATS_DAYS} дн.: {users['new_today']} / {users['new_period']}",
+        f"Активных сегодня / за {STATS_DAYS} дн.: {users['active_today']} / {users['active_period']}\n",
+        f"<b>Заявки за {STATS_DAYS} дн.:</b>",
+        *(f"{row['day']:%d.%m}: {row['requests']}" for row in stats["by_day"]),
+        "\n<b>Заявки по статусам:</b>",
+        *(f"{html.escape(row['status'] or '-')}: {row['requests']}" for row in stats["by_status"]),
+        f"\n<b>Популярные варианты услуг за {STATS_DAYS} дн.:</b>",
+        *(f"{html.escape(row['name'])}: {row['requests']}" for row in stats["top_options"]),
+    ]
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+# Объект удаления -> (подпись количества в ответе, подсказка по аргументам)
+DELETE_COMMANDS = {
+    "requests": ("Удалено заявок", "/delete_request 5 7 10-20 [user=id] [status=...] [before=ГГГГ-ММ-ДД]"),
+    "users": ("Удалено пользователей", "/delete_user 5 7 10-20 [before=ГГГГ-ММ-ДД]"),
+    "services": ("Удалено услуг", "/delete_service 5 7 10-20"),
+    "faq": ("Удалено вопросов FAQ", "/delete_faq 5 7 10-20"),
+}
+
+async def run_delete_command(message: types.Message, kind: str):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
+
+    label, usage = DELETE_COMMANDS[kind]
     try:
-        user_id = int(message.text.split()[1])
-    except (IndexError, ValueError):
-        await message.answer("❌ Использование: /delete_user [id]")
+        ids, ranges, filters = parse_delete_args(kind, message.text.split()[1:])
+    except ValueError:
+        await message.answer(f"❌ Использование: {usage}")
         return
-    
-    if await delete_user(user_id):
-        await message.answer(f"✅ Пользователь #{user_id} удален")
+
+    deleted = await bulk_delete(kind, ids, ranges, filters)
+    db_router.mark_write(message.from_user.id)
+    if deleted:
+        await message.answer(f"✅ {label}: {deleted}")
     else:
-        await message.answer("❌ Пользователь не найден")
+        await message.answer("❌ Ничего не найдено")
+
+@dp.message(Command("delete_request"))
+async def delete_request_cmd(message: types.Message):
+    await run_delete_command(message, "requests")
+
+@dp.message(Command("delete_user"))
+async def delete_user_cmd(message: types.Message):
+    await run_delete_command(message, "users")
 
 @dp.message(Command("delete_service"))
 async def delete_service_cmd(message: types.Message):
+    await run_delete_command(message, "services")
+
+@dp.message(Command("delete_faq"))
+async def delete_faq_cmd(message: types.Message):
+    await run_delete_command(message, "faq")
+
+@dp.message(Command("clear_requests"))
+async def clear_requests_cmd(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
     
-    try:
-        service_id = int(message.text.split()[1])
-    except (IndexError, ValueError):
-        await message.answer("❌ Использование: /delete_service [id]")
+    await clear_all_requests()
+    db_router.mark_write(message.from_user.id)
+    await message.answer("✅ Все заявки удалены")
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("⛔ У вас нет прав администратора")
         return
-    
-    if await delete_service(service_id):
-        await message.answer(f"✅ Услуга #{service_id} удалена")
-    else:
-        await message.answer("❌ Услуга не найдена")
 
-@dp.message(Command("delete_faq"))
-async def delete_faq_cmd(message: types.Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("❌ Использование: /broadcast [текст]")
+        return
+
+    broadcast_id = await broadcasts.create(message.from_user.id, parts[1])
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена")
+
+@dp.message(Command("broadcast_cancel"))
+async def broadcast_cancel_cmd(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
+
     try:
-        faq_id = int(message.text.split()[1])
+        broadcast_id = int(message.text.split()[1])
     except (IndexError, ValueError):
-        await message.answer("❌ Использование: /delete_faq [id]")
+        await message.answer("❌ Использование: /broadcast_cancel [id]")
         return
-    
-    if await delete_faq(faq_id):
-        await message.answer(f"✅ Вопрос FAQ #{faq_id} удален")
+
+    if await broadcasts.cancel(broadcast_id):
+        await message.answer(f"✅ Рассылка #{broadcast_id} остановлена")
     else:
-        await message.answer("❌ Вопрос не найден")
+        await message.answer("❌ Активная рассылка не найдена")
 
-@dp.message(Command("clear_requests"))
-async def clear_requests_cmd(message: types.Message):
+EXPORT_USAGE = "❌ Использование: /export requests|users [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [status=...] [format=xlsx]"
+
+@dp.message(Command("export"))
+async def export_cmd(message: types.Message):
     if not is_admin(message.from_user.id):
         await message.answer("⛔ У вас нет прав администратора")
         return
-    
-    await clear_all_requests()
-    await message.answer("✅ Все заявки удалены")
 
+    args = message.text.split()[1:]
+    if not args or args[0] not in EXPORTS:
+        await message.answer(EXPORT_USAGE)
+        return
+
+    dates, options = [], {}
+    try:
+        for arg in args[1:]:
+            if "=" in arg:
+                key, value = arg.split("=", 1)
+                options[key] = value
+            else:
+                dates.append(datetime.strptime(arg, "%Y-%m-%d"))
+    except ValueError:
+        await message.answer(EXPORT_USAGE)
+        return
+    file_format = options.get("format", "csv")
+    if len(dates) > 2 or file_format not in ("csv", "xlsx") or set(options) - {"status", "format"}:
+        await message.answer(EXPORT_USAGE)
+        return
+    if file_format == "xlsx" and Workbook is None:
+        await message.answer("❌ Для выгрузки в XLSX установите пакет openpyxl")
+        return
+
+    date_from = dates[0] if dates else None
+    # Дата окончания включается в выгрузку целиком
+    date_to = dates[1] + timedelta(days=1) if len(dates) == 2 else None
+
+    await message.answer("⏳ Готовим выгрузку...")
+    path, rows = await export_table(
+        args[0], file_format, date_from, date_to, options.get("status"), message.from_user.id
+    )
+    try:
+        filename = f"{args[0]}_{datetime.now():%Y%m%d_%H%M%S}.{'csv.gz' if file_format == 'csv' else 'xlsx'}"
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"✅ Выгружено строк: {rows}")
+    finally:
+        os.remove(path)
+
+
+# ================== ОГРАНИЧЕНИЕ ЧАСТОТЫ ==================
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "warned")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.warned = False
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_to_token(self) -> float:
+        return (1 - self.tokens) / self.rate
+
+    async def wait(self):
+        """Дождаться свободного токена"""
+        while not self.consume():
+            await asyncio.sleep(self.time_to_token())
+
+class BucketStore:
+    """Ведра по ключам с вытеснением давно не использованных (LRU)"""
+
+    def __init__(self, rate: float, capacity: float, max_size: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты сообщений от пользователя.
+
+    Сначала проверяется локальное ведро; если задан Redis, дополнительно
+    учитывается общий для всех реплик счетчик за окно shared_window.
+    Первое отклоненное сообщение получает предупреждение, остальные молча отбрасываются.
+    """
+
+    def __init__(self, rate: float, burst: int, max_buckets: int, shared_window: int):
+        self.buckets = BucketStore(rate, burst, max_buckets)
+        self.shared_window = shared_window
+        self.shared_limit = int(burst + rate * shared_window)
+
+    async def _allow_shared(self, user_id: int) -> bool:
+        key = f"throttle:{user_id}:{int(time.time()) // self.shared_window}"
+        try:
+            count = await redis_client.incr(key)
+            if count == 1:
+                await redis_client.expire(key, self.shared_window)
+        except Exception as e:
+            logger.error("Ошибка общего счетчика частоты: %s", e)
+            return True
+        return count <= self.shared_limit
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or is_admin(user.id):
+            return await handler(event, data)
+
+        bucket = self.buckets.get(user.id)
+        allowed = bucket.consume()
+        if allowed and redis_client is not None:
+            allowed = await self._allow_shared(user.id)
+        if allowed:
+            bucket.warned = False
+            return await handler(event, data)
+
+        if not bucket.warned:
+            bucket.warned = True
+            await event.answer("⏳ Слишком много сообщений, попробуйте немного позже")
+        return None
+
+class SendRateLimiter(BaseRequestMiddleware):
+    """Ограничение исходящих запросов к Bot API.
+
+    Запросы с chat_id ждут токен в общем ведре бота и в ведре чата, а при
+    ответе RetryAfter повторяются после указанной Telegram паузы.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, max_chats: int,
+                 max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = BucketStore(chat_rate, chat_burst, max_chats)
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None:
+            await self.chat_buckets.get(chat_id).wait()
+            await self.global_bucket.wait()
+
+        attempt = 0
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logger.warning("Telegram просит подождать %s с перед %s", e.retry_after, type(method).__name__)
+                await asyncio.sleep(e.retry_after)
+
+dp.message.outer_middleware(ThrottlingMiddleware(**RATE_LIMIT_CONFIG))
+send_limiter = SendRateLimiter(**SEND_LIMIT_CONFIG)
+bot.session.middleware(send_limiter)
+
+# ================== ДЕДУПЛИКАЦИЯ ОБНОВЛЕНИЙ ==================
+
+dedup_logger = logger.getChild("dedup")
+
+class UpdateDeduplicationMiddleware(BaseMiddleware):
+    """Отбрасывание повторно доставленных обновлений по update_id.
+
+    Недавние update_id хранятся в памяти (LRU с ограничением max_size и сроком
+    ttl); если задан Redis, дополнительно проверяется общий для всех реплик
+    ключ SET NX. Если обработка завершилась исключением, отметка снимается,
+    чтобы повторная доставка могла быть обработана.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen = OrderedDict()  # update_id -> момент истечения, от старых к новым
+
+    def _seen_locally(self, update_id: int) -> bool:
+        now = time.monotonic()
+        while self._seen:
+            oldest_id, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.max_size:
+                break
+            del self._seen[oldest_id]
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = now + self.ttl
+        return False
+
+    async def _seen_shared(self, update_id: int) -> bool:
+        try:
+            return not await redis_client.set(f"update:{update_id}", 1, nx=True, ex=int(self.ttl))
+        except Exception as e:
+            logger.error("Ошибка общей проверки повторов обновлений: %s", e)
+            return False
+
+    async def _forget(self, update_id: int):
+        self._seen.pop(update_id, None)
+        if redis_client is not None:
+            with contextlib.suppress(Exception):
+                await redis_client.delete(f"update:{update_id}")
+
+    async def __call__(self, handler, event, data):
+        update_id = event.update_id
+        duplicate = self._seen_locally(update_id)
+        if not duplicate and redis_client is not None:
+            duplicate = await self._seen_shared(update_id)
+        if duplicate:
+            dedup_logger.info("Повторное обновление %s пропущено", update_id)
+            return None
+        try:
+            return await handler(event, data)
+        except Exception:
+            await self._forget(update_id)
+            raise
+
+dp.update.outer_middleware(UpdateDeduplicationMiddleware(**DEDUP_CONFIG))
+
+# ================== МЕТРИКИ ==================
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names: tuple, values: tuple) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+class Gauge:
+    """Значение вычисляется функцией в момент чтения метрик.
+
+    Для метрики с метками read возвращает словарь: значения меток -> значение.
+    """
+
+    def __init__(self, name: str, help_text: str, read, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.labels = labels
+
+    def render(self):
+        value = self.read()
+        if value is None:
+            return
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        if not self.labels:
+            yield f"{self.name} {value}"
+            return
+        for label_values, item in value.items():
+            yield f"{self.name}{format_labels(self.labels, label_values)} {item}"
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # значения меток -> [счетчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            # корзины, переполнение, сумма, количество
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        bucket_labels = self.labels + ("le",)
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{format_labels(bucket_labels, label_values + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {series[-2]}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {series[-1]}"
+
+UPDATES_TOTAL = Counter("bot_updates_total", "Обработанные обновления", ("type",))
+UPDATE_ERRORS_TOTAL = Counter("bot_update_errors_total", "Обновления, завершившиеся исключением", ("type",))
+HANDLER_SECONDS = Histogram("bot_handler_duration_seconds", "Время работы обработчика", ("handler",))
+API_SECONDS = Histogram("bot_api_request_duration_seconds", "Время вызова Bot API", ("method",))
+API_ERRORS_TOTAL = Counter("bot_api_errors_total", "Ошибки вызовов Bot API", ("method", "error"))
+DB_ACQUIRE_SECONDS = Histogram("db_pool_acquire_seconds", "Ожидание свободного соединения в пуле")
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds", "Время выполнения запроса", ("query",))
+DB_QUERY_ERRORS_TOTAL = Counter("db_query_errors_total", "Запросы, завершившиеся ошибкой", ("query",))
+
+def pool_stat(read):
+    return lambda: read(db_pool) if db_pool is not None else None
+
+METRICS = [
+    UPDATES_TOTAL, UPDATE_ERRORS_TOTAL, HANDLER_SECONDS, API_SECONDS, API_ERRORS_TOTAL,
+    DB_ACQUIRE_SECONDS, DB_QUERY_SECONDS, DB_QUERY_ERRORS_TOTAL,
+    Gauge("db_pool_size", "Открытые соединения пула", pool_stat(lambda pool: pool.get_size())),
+    Gauge("db_pool_max_size", "Максимальный размер пула", pool_stat(lambda pool: pool.get_max_size())),
+    Gauge("db_pool_in_use", "Занятые соединения пула",
+          pool_stat(lambda pool: pool.get_size() - pool.get_idle_size())),
+    Gauge("db_replicas_healthy", "Реплики, на которые сейчас направляются чтения",
+          lambda: sum(db_router.healthy) if db_router.replicas else None),
+    Gauge("bot_log_records_dropped", "Записи журнала, отброшенные выборкой или при переполнении очереди",
+          lambda: {("sampled",): log_sampler.dropped, ("queue_full",): getattr(log_handler, "dropped", 0)},
+          ("reason",)),
+    Gauge("db_circuit_open", "1, пока цепь к основной БД разомкнута или пропускает пробный запрос",
+          lambda: int(db_breaker.state != "closed")),
+    Gauge("spool_pending", "Записи локального журнала, ожидающие переноса в БД",
+          lambda: request_spool.size),
+    Gauge("bot_ready", "1, когда завершены все шаги запуска, нужные для обработки сообщений",
+          lambda: int(is_ready())),
+    Gauge("bot_startup_step_seconds", "Длительность шагов запуска",
+          lambda: {(step,): seconds for step, seconds in startup_timings.items()}, ("step",)),
+]
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+# Имена запросов реестра для меток; остальные запросы учитываются как "other"
+QUERY_NAMES = {query: name for name, query in QUERIES.items()}
+
+def observe_query(record):
+    """Логгер запросов asyncpg: время и ошибки запросов вне реестра (см. TimedStatement)"""
+    name = QUERY_NAMES.get(record.query, "other")
+    DB_QUERY_SECONDS.observe(record.elapsed, name)
+    if record.exception is not None:
+        DB_QUERY_ERRORS_TOTAL.inc(name)
+
+class InstrumentedPool:
+    """Обертка над пулом asyncpg с замером ожидания свободного соединения"""
+
+    def __init__(self, pool: asyncpg.pool.Pool, breaker: "CircuitBreaker" = None):
+        self._pool = pool
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, *, timeout: float = None):
+        if self._breaker is None:
+            started = time.perf_counter()
+            async with self._pool.acquire(timeout=timeout) as conn:
+                DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+                yield conn
+            return
+
+        self._breaker.before_call()
+        try:
+            started = time.perf_counter()
+            async with self._pool.acquire(timeout=timeout or self._breaker.acquire_timeout) as conn:
+                DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+                yield conn
+        except DB_UNAVAILABLE_ERRORS:
+            self._breaker.record(False)
+            raise
+        except asyncio.CancelledError:
+            self._breaker.cancel_probe()
+            raise
+        except BaseException:
+            # Ошибка в данных или в самом обработчике: БД ответила
+            self._breaker.record(True)
+            raise
+        else:
+            self._breaker.record(True)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Подсчет обновлений по типам"""
+
+    async def __call__(self, handler, event, data):
+        update_type = event.event_type
+        UPDATES_TOTAL.inc(update_type)
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS_TOTAL.inc(update_type)
+            raise
+
+# Маршрут внутри общего обработчика текста (process_any_message) для метки handler
+handler_route = contextvars.ContextVar("handler_route", default=None)
+
+def set_handler_route(route):
+    """Отметить маршрут обработки; route - обработчик (в том числе partial) или имя"""
+    handler_route.set(route if isinstance(route, str) else getattr(route, "func", route).__name__)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы обработчиков; для общего обработчика текста - по выбранному маршруту"""
+
+    async def __call__(self, handler, event, data):
+        token = handler_route.set(None)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = handler_route.get() or data["handler"].callback.__name__
+            handler_route.reset(token)
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки вызовов Bot API (без ожидания в ограничителе частоты)"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS_TOTAL.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, name)
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def healthz_handler(request: web.Request):
+    """Проба живости: цикл событий отвечает на запросы"""
+    return web.json_response({"status": "ok"})
+
+def startup_state() -> tuple:
+    """Готовность процесса и подробности для /readyz: 503, пока не завершены шаги из startup_pending"""
+    return is_ready(), {"pending": sorted(startup_pending), "startup_seconds": startup_timings}
+
+def create_probe_app(state) -> web.Application:
+    """Приложение с /healthz и /readyz; state() возвращает (готов ли, подробности)"""
+
+    async def readyz_handler(request: web.Request):
+        ready, details = state()
+        return web.json_response({"ready": ready, **details}, status=200 if ready else 503)
+
+    app = web.Application()
+    app.router.add_get("/healthz", healthz_handler)
+    app.router.add_get("/readyz", readyz_handler)
+    return app
+
+async def start_http_server(app: web.Application, config: dict) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config["host"], config["port"]).start()
+    return runner
+
+metrics_runner: web.AppRunner = None
+probe_runner: web.AppRunner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    app = create_probe_app(startup_state)
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = await start_http_server(app, METRICS_CONFIG)
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_CONFIG['host'], METRICS_CONFIG['port'])
+
+async def start_probe_server(state=startup_state):
+    global probe_runner
+    probe_runner = await start_http_server(create_probe_app(state), PROBE_CONFIG)
+    logger.info("Пробы доступны на http://%s:%s/readyz", PROBE_CONFIG['host'], PROBE_CONFIG['port'])
+
+async def stop_metrics_server():
+    for runner in (metrics_runner, probe_runner):
+        if runner is not None:
+            await runner.cleanup()
+
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+# Регистрируется после SendRateLimiter, поэтому замеряет только сам вызов API
+bot.session.middleware(ApiMetricsMiddleware())
+
+# ================== РАССЫЛКИ ==================
+
+class BroadcastScheduler:
+    """Фоновые рассылки всем пользователям.
+
+    Получатели читаются из users порциями по chunk_size через серверный курсор
+    и рассылаются несколькими воркерами с общим ведром токенов. После каждой
+    порции прогресс сохраняется в broadcasts, поэтому после перезапуска рассылка
+    продолжается с места остановки. Пользователи, заблокировавшие бота, помечаются
+    и в следующих рассылках пропускаются.
+    """
+
+    def __init__(self, rate: float, workers: int, chunk_size: int, report_interval: float,
+                 lease_timeout: float):
+        self.rate = rate
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.report_interval = report_interval
+        self.lease_timeout = lease_timeout
+        self._jobs = {}
+        self._watcher = None
+
+    async def create(self, admin_id: int, text: str) -> int:
+        async with db_pool.acquire() as conn:
+            broadcast = await conn.fetchrow('''
+                INSERT INTO broadcasts (admin_id, text)
+                VALUES ($1, $2)
+                RETURNING broadcast_id, admin_id, text, last_user_id, sent, failed, blocked
+            ''', admin_id, text)
+        self._start(broadcast)
+        return broadcast["broadcast_id"]
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        async with db_pool.acquire() as conn:
+            result = await conn.execute('''
+                UPDATE broadcasts SET status = 'cancelled', finished_at = NOW()
+                WHERE broadcast_id = $1 AND status = 'running'
+            ''', broadcast_id)
+        # Рассылка в другом процессе увидит новый статус при следующем сохранении прогресса
+        job = self._jobs.get(broadcast_id)
+        if job is not None:
+            job.cancel()
+        return int(result.split()[-1]) > 0
+
+    def start(self):
+        """Запуск проверки рассылок без владельца (в том числе прерванных перезапуском)"""
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        tasks = [self._watcher, *self._jobs.values()] if self._watcher else list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _watch(self):
+        while True:
+            try:
+                async with db_pool.acquire() as conn:
+                    claimed = await conn.statements["broadcast_claim"].fetch(self.lease_timeout)
+                for broadcast in claimed:
+                    logger.info("Продолжаем рассылку #%s", broadcast['broadcast_id'])
+                    self._start(broadcast)
+            except Exception as e:
+                logger.error("Ошибка проверки рассылок: %s", e)
+            await asyncio.sleep(self.lease_timeout / 2)
+
+    def _start(self, broadcast):
+        broadcast_id = broadcast["broadcast_id"]
+        if broadcast_id in self._jobs:
+            return
+        task = asyncio.create_task(self._run(broadcast))
+        self._jobs[broadcast_id] = task
+        task.add_done_callback(lambda _: self._jobs.pop(broadcast_id, None))
+
+    async def _send(self, bucket: TokenBucket, user_id: int, text: str) -> str:
+        await bucket.wait()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logger.warning("Рассылка: не удалось отправить сообщение %s: %s", user_id, e)
+            return "failed"
+
+    async def _run(self, broadcast):
+        broadcast_id = broadcast["broadcast_id"]
+        admin_id = broadcast["admin_id"]
+        text = broadcast["text"]
+        last_user_id = broadcast["last_user_id"]
+        totals = {"sent": broadcast["sent"], "failed": broadcast["failed"], "blocked": broadcast["blocked"]}
+        bucket = TokenBucket(self.rate, max(self.rate, 1))
+        started = time.monotonic()
+        sent_at_start = totals["sent"]
+        last_report = started
+        report = None
+        status = "done"
+
+        while True:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    recipients = [
+                        record["user_id"] async for record in conn.statements["broadcast_recipients"].cursor(
+                            last_user_id if last_user_id is not None else -2 ** 63, self.chunk_size
+                        )
+                    ]
+            if not recipients:
+                break
+
+            queue = asyncio.Queue()
+            for user_id in recipients:
+                queue.put_nowait(user_id)
+            results = {}
+
+            async def worker():
+                while not queue.empty():
+                    user_id = queue.get_nowait()
+                    results[user_id] = await self._send(bucket, user_id, text)
+
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+
+            chunk = {"sent": 0, "failed": 0, "blocked": 0}
+            for result in results.values():
+                chunk[result] += 1
+            for key, value in chunk.items():
+                totals[key] += value
+            last_user_id = recipients[-1]
+
+            async with db_pool.acquire() as conn:
+                blocked_ids = [user_id for user_id, result in results.items() if result == "blocked"]
+                if blocked_ids:
+                    await conn.statements["mark_users_blocked"].fetch(blocked_ids)
+                status = await conn.statements["broadcast_checkpoint"].fetchval(
+                    broadcast_id, last_user_id, chunk["sent"], chunk["failed"], chunk["blocked"]
+                )
+            if status != "running":
+                break
+            status = "done"
+
+            now = time.monotonic()
+            if now - last_report >= self.report_interval:
+                last_report = now
+                report = await self._report(admin_id, broadcast_id, totals, started, sent_at_start, report)
+
+        if status == "done":
+            async with db_pool.acquire() as conn:
+                await conn.statements["broadcast_finish"].fetch(broadcast_id, "done")
+        await self._report(admin_id, broadcast_id, totals, started, sent_at_start, report, status)
+        logger.info("Рассылка #%s завершена со статусом %s: %s", broadcast_id, status, totals)
+
+    async def _report(self, admin_id: int, broadcast_id: int, totals: dict, started: float,
+                      sent_at_start: int, report: types.Message = None, status: str = "running"):
+        """Отправка или обновление сообщения с прогрессом рассылки"""
+        rate = (totals["sent"] - sent_at_start) / max(time.monotonic() - started, 0.001)
+        titles = {"running": "идет", "done": "завершена", "cancelled": "остановлена"}
+        text = (
+            f"📣 Рассылка #{broadcast_id} {titles.get(status, status)}\n"
+            f"Отправлено: {totals['sent']}\n"
+            f"Заблокировали бота: {totals['blocked']}\n"
+            f"Ошибок: {totals['failed']}\n"
+            f"Скорость: {rate:.1f} сообщ./с"
+        )
+        try:
+            if report is None:
+                return await bot.send_message(admin_id, text)
+            await report.edit_text(text)
+        except Exception as e:
+            logger.error("Не удалось отправить отчет о рассылке #%s: %s", broadcast_id, e)
+        return report
+
+broadcasts = BroadcastScheduler(**BROADCAST_CONFIG)
+
+# ================== ВЫГРУЗКА ==================
+
+# Таблица -> (колонки, колонка даты для фильтра, есть ли статус)
+EXPORTS = {
+    "requests": (
+        "request_id, user_id, request_date, status, service_option_id, request_text",
+        "request_date",
+        True,
+    ),
+    "users": (
+        "user_id, username, full_name, registration_date, last_activity",
+        "registration_date",
+        False,
+    ),
+}
+
+def export_query(table: str, status: str = None) -> str:
+    columns, date_column, has_status = EXPORTS[table]
+    conditions = [
+        f"($1::timestamp IS NULL OR {date_column} >= $1)",
+        f"($2::timestamp IS NULL OR {date_column} < $2)",
+    ]
+    if has_status and status is not None:
+        conditions.append("status = $3")
+    return f"SELECT {columns} FROM {table} WHERE {' AND '.join(conditions)} ORDER BY {date_column}"
+
+async def export_table(table: str, file_format: str, date_from: datetime = None, date_to: datetime = None,
+                       status: str = None, user_id: int = None):
+    """Выгрузка таблицы во временный файл; возвращает путь и число строк.
+
+    CSV выгружается через COPY ... TO STDOUT и по частям сжимается gzip, XLSX
+    собирается построчно из серверного курсора. Вся выборка в памяти не хранится.
+    Выгрузка читается с реплики, если она есть.
+    """
+    args = [date_from, date_to]
+    if EXPORTS[table][2] and status is not None:
+        args.append(status)
+    query = export_query(table, status)
+
+    fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(fd)
+    # Файл открывается заново при каждой попытке, поэтому повтор в основной БД перезапишет его
+    async def write_export(conn):
+        if file_format != "csv":
+            return await export_xlsx(conn, query, args, path)
+        with gzip.open(path, "wb") as archive:
+            async def write_chunk(chunk: bytes):
+                await asyncio.to_thread(archive.write, chunk)
+
+            result = await conn.copy_from_query(
+                query, *args, output=write_chunk, format="csv", header=True
+            )
+        return int(result.split()[-1])
+
+    try:
+        rows = await db_router.read(write_export, user_id)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, rows
+
+async def export_xlsx(conn, query: str, args: list, path: str, batch_size: int = 1000) -> int:
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    rows = 0
+    batch = []
+
+    def append_batch(records):
+        for record in records:
+            sheet.append(list(record.values()))
+
+    async with conn.transaction():
+        cursor = conn.cursor(query, *args, prefetch=batch_size)
+        async for record in cursor:
+            if rows == 0:
+                sheet.append(list(record.keys()))
+            batch.append(record)
+            rows += 1
+            if len(batch) >= batch_size:
+                await asyncio.to_thread(append_batch, batch)
+                batch = []
+    if batch:
+        await asyncio.to_thread(append_batch, batch)
+    await asyncio.to_thread(workbook.save, path)
+    return rows
 
 # ================== ОБРАБОТЧИКИ СООБЩЕНИЙ ==================
 
@@ -529,8 +3356,9 @@ async def cmd_start(message: types.Message):
         full_name=message.from_user.full_name
     )
     try:
-        await message.answer_photo(
-            photo=START_IMAGE_URL,
+        await media_cache.send_photo(
+            message.chat.id,
+            "start_banner",
             caption="🛠 <b>IT-Аутсорсинг PRO</b>\n\n"
                     "Профессиональная разработка веб и мобильных решений\n\n"
                     "Выберите нужный вариант:",
@@ -538,7 +3366,7 @@ async def cmd_start(message: types.Message):
             reply_markup=get_main_kb()
         )
     except Exception as e:
-        logger.error(f"Ошибка загрузки изображения: {e}")
+        logger.error("Ошибка загрузки изображения: %s", e)
         await message.answer(
             "🛠 <b>Добро пожаловать в IT-Аутсорсинг PRO</b>\n\n"
             "Выберите действие:",
@@ -546,7 +3374,6 @@ async def cmd_start(message: types.Message):
             reply_markup=get_main_kb()
         )
 
-@dp.message(F.text == "🚨 IT-Аутсорсинг")
 async def outsource_menu(message: types.Message):
     await message.answer(
         "🖥 <b>Направления разработки:</b>\n\n"
@@ -560,32 +3387,23 @@ async def outsource_menu(message: types.Message):
 async def clear_db_command(message: types.Message):
     if message.from_user.id == 1072196801:  
         await clear_all_requests()
+        db_router.mark_write(message.from_user.id)
         await message.answer("✅ Все заявки удалены")
     else:
         await message.answer("⛔ У вас нет прав на эту операцию")    
 
-@dp.message(F.text.in_(["🌐 Веб-разработка", "📱 Мобильные приложения"]))
 async def service_menu_handler(message: types.Message):
-    services = await get_services()
-    service = next((s for s in services if s["name"] == message.text), None)
+    service = catalog.services.get(message.text)
     if not service:
         await message.answer("Услуга не найдена")
         return
 
-    options = await get_service_options(service["service_id"])
-    builder = ReplyKeyboardBuilder()
-    for option in options:
-        builder.add(KeyboardButton(text=option["name"]))
-    builder.add(KeyboardButton(text="🔙 Назад"))
-    builder.adjust(1)
-
     await message.answer(
         f"<b>{service['name']}</b>\n\n{service['description']}\n\nВыберите тип проекта:",
         parse_mode="HTML",
-        reply_markup=builder.as_markup(resize_keyboard=True)
+        reply_markup=get_service_kb(service["service_id"])
     )
 
-@dp.message(F.text == "❓ Частые вопросы")
 async def help_handler(message: types.Message):
     await message.answer(
         "❓ <b>Часто задаваемые вопросы:</b>\n"
@@ -595,7 +3413,6 @@ async def help_handler(message: types.Message):
     )
 
 
-@dp.message(F.text == "📞 Контакты")
 async def contacts_handler(message: types.Message):
     await message.answer(
         "📞 <b>Наши контакты:</b>\n\n"
@@ -608,7 +3425,6 @@ async def contacts_handler(message: types.Message):
     )
 
 
-@dp.message(F.text == "📨 Оставить заявку")
 async def create_request_handler(message: types.Message):
     await message.answer(
         "✍️ <b>Опишите ваш проект:</b>\n\n"
@@ -622,51 +3438,113 @@ async def create_request_handler(message: types.Message):
         reply_markup=get_back_kb()
     )
 
-@dp.message(F.text == "🔙 Назад")
 async def back_handler(message: types.Message):
     await message.answer(
         "Главное меню:",
         reply_markup=get_main_kb()
     )
 
-@dp.message()
+async def faq_answer_handler(message: types.Message, question: str, answer: str):
+    await message.answer(
+        f"<b>{question}</b>\n\n{answer}",
+        parse_mode="HTML",
+        reply_markup=get_help_kb()
+    )
+
+async def option_handler(message: types.Message, option):
+    await message.answer(
+        f"<b>{option['name']}</b>\n\n"
+        f"{option['description']}\n\n"
+        f"<b>Стоимость:</b> {option['price']}\n\n"
+        "✍️ Для заказа нажмите кнопку 'Оставить заявку' или напишите:\n"
+        "1. Описание проекта\n2. Желаемые сроки\n3. Бюджет (если есть)",
+        parse_mode="HTML",
+        reply_markup=get_back_kb()
+    )
+
+# ================== МАРШРУТИЗАЦИЯ ТЕКСТА ==================
+
+# Кнопки меню с постоянным текстом
+STATIC_ROUTES = {
+    "🚨 IT-Аутсорсинг": outsource_menu,
+    "❓ Частые вопросы": help_handler,
+    "📞 Контакты": contacts_handler,
+    "📨 Оставить заявку": create_request_handler,
+    "🔙 Назад": back_handler,
+}
+
+class TextRouter:
+    """Таблица маршрутизации: точный текст сообщения -> обработчик.
+
+    Вместо цепочки фильтров и запросов к БД сообщение классифицируется одним
+    поиском в словаре. Таблица пересобирается при смене версии каталога.
+    Приоритет совпадений: кнопки меню, услуги, вопросы FAQ, варианты услуг.
+    """
+
+    def __init__(self, static_routes: dict):
+        self.static_routes = static_routes
+        self._routes = {}
+        self._catalog_version = None
+
+    def resolve(self, text: str):
+        if self._catalog_version != catalog.version:
+            self._rebuild()
+        return self._routes.get(text)
+
+    def _rebuild(self):
+        routes = {}
+        for name, option in catalog.options.items():
+            routes[name] = functools.partial(option_handler, option=option)
+        for question, answer in catalog.faq.items():
+            routes[question] = functools.partial(faq_answer_handler, question=question, answer=answer)
+        for name in catalog.services:
+            routes[name] = service_menu_handler
+        routes.update(self.static_routes)
+        self._routes = routes
+        self._catalog_version = catalog.version
+
+text_router = TextRouter(STATIC_ROUTES)
+
+@dp.message(F.text)
 async def process_any_message(message: types.Message):
-    # Проверяем, является ли сообщение вопросом из FAQ
-    faq_answer = await get_faq_answer(message.text)
-    if faq_answer:
-        await message.answer(
-            f"<b>{message.text}</b>\n\n{faq_answer}",
-            parse_mode="HTML",
-            reply_markup=get_help_kb()
-        )
+    handler = text_router.resolve(message.text)
+    if handler is None and not catalog.loaded.is_set():
+        # Пока каталог загружается, текст может оказаться услугой, вариантом или вопросом FAQ
+        await catalog.loaded.wait()
+        handler = text_router.resolve(message.text)
+    if handler is not None:
+        set_handler_route(handler)
+        await handler(message)
         return
 
-    # Проверяем, является ли сообщение вариантом услуги
-    async with db_pool.acquire() as conn:
-        option = await conn.fetchrow('''
-            SELECT so.*, s.name as service_name 
-            FROM service_options so
-            JOIN services s ON so.service_id = s.service_id
-            WHERE so.name = $1
-        ''', message.text)
-
-    if option:
-        await message.answer(
-            f"<b>{option['name']}</b>\n\n"
-            f"{option['description']}\n\n"
-            f"<b>Стоимость:</b> {option['price']}\n\n"
-            "✍️ Для заказа нажмите кнопку 'Оставить заявку' или напишите:\n"
-            "1. Описание проекта\n2. Желаемые сроки\n3. Бюджет (если есть)",
-            parse_mode="HTML",
-            reply_markup=get_back_kb()
-        )
+    # Вопрос, сформулированный своими словами, получает ответ из FAQ, а не становится заявкой
+    faq_match = catalog.faq_matcher.match(message.text)
+    if faq_match is not None:
+        set_handler_route("faq_match")
+        question, answer = faq_match
+        await faq_answer_handler(message, question, answer)
         return
 
     # Если это не команда и не известный текст, считаем заявкой
-    request_id = await create_request(
+    set_handler_route("create_request")
+    request_id = await request_batcher.submit(
         user_id=message.from_user.id,
-        request_text=message.text
+        request_text=message.text,
+        message_id=message.message_id
     )
+    if request_id is None:
+        # Заявка из этого сообщения уже создана при предыдущей доставке, подтверждение отправлено
+        dedup_logger.info("Повторная заявка из сообщения %s пользователя %s", message.message_id, message.from_user.id)
+        return
+    if request_id is REQUEST_SPOOLED:
+        # Номер будет присвоен, когда заявка попадет из локального журнала в БД
+        await message.answer(
+            "✅ <b>Ваше сообщение принято как заявка!</b>\n\n"
+            "Мы свяжемся с вами в ближайшее время для уточнения деталей.",
+            parse_mode="HTML",
+            reply_markup=get_main_kb()
+        )
+        return
 
     await message.answer(
         "✅ <b>Ваше сообщение принято как заявка!</b>\n\n"
@@ -678,25 +3556,466 @@ async def process_any_message(message: types.Message):
 
 # ================== ЗАПУСК БОТА ==================
 
-async def on_startup():
+# Шаг запуска -> длительность в секундах
+startup_timings = {}
+# Шаги, без которых бот не может полноценно обрабатывать сообщения (см. /readyz)
+startup_pending = {"db", "catalog"}
+# Устанавливается, когда завершены все шаги из startup_pending
+startup_ready = asyncio.Event()
+# Фоновые прогревы, запущенные при старте
+startup_tasks = set()
+startup_started: float = None
+
+def is_ready() -> bool:
+    return not startup_pending
+
+async def timed_step(name: str, step):
+    """Выполнение шага запуска step() с записью длительности в startup_timings"""
+    started = time.perf_counter()
+    result = await step()
+    startup_timings[name] = round(time.perf_counter() - started, 4)
+    if name in startup_pending:
+        startup_pending.discard(name)
+        if is_ready():
+            startup_ready.set()
+            startup_timings["ready"] = round(time.perf_counter() - startup_started, 4)
+            steps = ", ".join(f"{step_name} {seconds:.3f} с" for step_name, seconds in startup_timings.items())
+            logger.info("Бот готов: %s", steps)
+    return result
+
+async def warm_up(name: str, step):
+    """Фоновый шаг запуска; при ошибке повторяется с нарастающей паузой"""
+    delay = 1
+    while True:
+        try:
+            await timed_step(name, step)
+            return
+        except Exception as e:
+            logger.error("Ошибка шага запуска %s: %s, повтор через %s с", name, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+def start_warm_up(name: str, step):
+    task = asyncio.create_task(warm_up(name, step))
+    startup_tasks.add(task)
+    task.add_done_callback(startup_tasks.discard)
+
+async def open_database():
+    """Миграции и пул: соединения пула подготавливают запросы к уже существующим таблицам"""
     global db_pool
-    db_pool = await create_db_pool()
-    await init_db(db_pool)
-    dp["faq_questions"] = await get_faq_questions()
-    logger.info("Бот запущен и БД инициализирована")
+    await timed_step("migrations", init_db)
+    db_pool = await timed_step("pool", create_db_pool)
+
+async def load_catalog():
+    await catalog.load(db_pool)
+    await start_catalog_listener()
+
+async def load_media():
+    await media_cache.load()
+    if MEDIA_PREWARM_CHAT_ID is not None:
+        await media_cache.prewarm(MEDIA_PREWARM_CHAT_ID)
+
+async def on_startup():
+    """Запуск бота.
+
+    Получение обновлений ждет только миграций и пула соединений; сервер метрик
+    поднимается параллельно с ними. Каталог и медиафайлы загружаются в фоне:
+    /start и статические меню работают сразу, а сообщения, которым нужен
+    каталог, дожидаются его загрузки.
+    """
+    global startup_started
+    startup_started = time.perf_counter()
+    steps = [timed_step("db", open_database)]
+    # /healthz и /readyz отвечают уже во время миграций
+    if METRICS_CONFIG is not None:
+        steps.append(timed_step("metrics_server", start_metrics_server))
+    if PROBE_CONFIG is not None:
+        steps.append(timed_step("probe_server", start_probe_server))
+    await asyncio.gather(*steps)
+
+    user_activity.start(db_pool)
+    await request_spool.start()
+    db_router.start()
+    broadcasts.start()
+    request_archiver.start()
+    start_warm_up("catalog", load_catalog)
+    start_warm_up("media", load_media)
+    logger.info("Бот запущен за %.3f с, каталог загружается в фоне", time.perf_counter() - startup_started)
 
 async def on_shutdown():
+    for task in list(startup_tasks):
+        task.cancel()
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    await stop_metrics_server()
+    await stop_catalog_listener()
+    await broadcasts.stop()
+    await request_archiver.stop()
+    await request_batcher.stop()
+    await user_activity.stop()
+    # Последним: батчер и буфер пользователей при недоступной БД пишут в журнал
+    await request_spool.stop()
+    await db_router.stop()
     await db_pool.close()
+    if redis_client is not None:
+        await redis_client.aclose()
     await bot.close()
     logger.info("Пул соединений закрыт и бот остановлен")
 
+# ================== РЕЖИМ WEBHOOK ==================
+
+# Ограничение на число одновременно выполняемых обработчиков
+webhook_semaphore: asyncio.Semaphore = None
+# Принятые, но еще не обработанные обновления
+webhook_tasks = set()
+
+async def process_webhook_update(update: dict):
+    """Обработка обновления в фоне после ответа Telegram"""
+    async with webhook_semaphore:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.error("Ошибка обработки обновления %s: %s", update.get('update_id'), e)
+
+def accept_webhook_update(update: dict) -> bool:
+    """Запуск обработки в фоне; False, если принятых обновлений слишком много"""
+    if len(webhook_tasks) >= WEBHOOK_CONFIG["max_in_flight"]:
+        return False
+    task = asyncio.create_task(process_webhook_update(update))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return True
+
+def create_webhook_app(accept) -> web.Application:
+    """aiohttp-приложение, передающее обновления в accept(update) -> bool"""
+
+    async def webhook_handler(request: web.Request):
+        """Прием обновления: быстрый ответ 200, обработка в фоне"""
+        secret_token = WEBHOOK_CONFIG["secret_token"]
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        if not accept(update):
+            # Telegram повторит доставку позже, а балансировщик может направить ее в другую реплику
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_CONFIG["path"], webhook_handler)
+    return app
+
+async def start_webhook_server(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await bot.set_webhook(
+        url=WEBHOOK_CONFIG["base_url"] + WEBHOOK_CONFIG["path"],
+        secret_token=WEBHOOK_CONFIG["secret_token"] or None,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=100
+    )
+    site = web.TCPSite(runner, WEBHOOK_CONFIG["host"], WEBHOOK_CONFIG["port"])
+    await site.start()
+    logger.info("Webhook слушает %s:%s%s", WEBHOOK_CONFIG['host'], WEBHOOK_CONFIG['port'], WEBHOOK_CONFIG['path'])
+    return runner
+
+async def run_webhook():
+    """Запуск бота в режиме webhook на aiohttp"""
+    global webhook_semaphore
+    webhook_semaphore = asyncio.Semaphore(WEBHOOK_CONFIG["max_concurrency"])
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    runner = await start_webhook_server(create_webhook_app(accept_webhook_update))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Перестаем принимать обновления и дожидаемся уже принятых
+        await runner.cleanup()
+        if webhook_tasks:
+            await asyncio.gather(*webhook_tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+
+# ================== МНОГОПРОЦЕССНЫЙ РЕЖИМ ==================
+
+class HashRing:
+    """Консистентное хеширование ключей по воркерам с виртуальными узлами"""
+
+    def __init__(self, nodes: int, replicas: int = 100):
+        ring = sorted(
+            (zlib.crc32(f"{node}:{replica}".encode()), node)
+            for node in range(nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key) -> int:
+        position = bisect.bisect(self._hashes, zlib.crc32(str(key).encode())) % len(self._hashes)
+        return self._nodes[position]
+
+def update_chat_id(update: dict):
+    """chat_id из необработанного обновления (или id пользователя, если чата нет)"""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return update.get("update_id")
+
+async def feed_worker_updates(updates: multiprocessing.Queue):
+    """Цикл воркера: обновления одного чата обрабатываются строго по очереди.
+
+    Следующее обновление берется из очереди, только когда в воркере меньше
+    max_in_flight необработанных: иначе очередь не заполнится и основной
+    процесс не узнает о перегрузке.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(WEBHOOK_CONFIG["max_concurrency"])
+    in_flight = asyncio.Semaphore(WEBHOOK_CONFIG["max_in_flight"])
+    chat_tails = {}  # chat_id -> задача последнего обновления чата
+
+    async def process(update: dict, previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with semaphore:
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception as e:
+                logger.error("Ошибка обработки обновления %s: %s", update.get('update_id'), e)
+
+    def release(chat_id, task: asyncio.Task):
+        in_flight.release()
+        if chat_tails.get(chat_id) is task:
+            del chat_tails[chat_id]
+
+    while True:
+        await in_flight.acquire()
+        update = await loop.run_in_executor(None, updates.get)
+        if update is None:
+            in_flight.release()
+            break
+        chat_id = update_chat_id(update)
+        task = asyncio.create_task(process(update, chat_tails.get(chat_id)))
+        chat_tails[chat_id] = task
+        task.add_done_callback(functools.partial(release, chat_id))
+
+    if chat_tails:
+        await asyncio.gather(*chat_tails.values(), return_exceptions=True)
+
+def worker_main(index: int, updates: multiprocessing.Queue, pool_size: int, ready):
+    """Точка входа процесса-воркера со своими Dispatcher, Bot и пулом соединений.
+
+    ready - общий с основным процессом флаг готовности воркера для его /readyz.
+    """
+    global METRICS_CONFIG, PROBE_CONFIG
+    # Остановкой воркеров управляет основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    DB_POOL_CONFIG["max_size"] = pool_size
+    DB_POOL_CONFIG["min_size"] = min(DB_POOL_CONFIG["min_size"], pool_size)
+    if METRICS_CONFIG is not None:
+        METRICS_CONFIG = {**METRICS_CONFIG, "port": METRICS_CONFIG["port"] + 1 + index}
+    # Пробы отдает основной процесс, который и принимает обновления
+    PROBE_CONFIG = None
+    # У каждого воркера свой журнал: SQLite не рассчитан на запись из нескольких процессов сразу
+    request_spool.path = f"{SPOOL_CONFIG['path']}.worker{index}"
+    request_spool.adopt_orphans = index == 0
+    # Лимит Telegram на исходящие сообщения общий для бота и делится между воркерами, как и пул
+    global_rate = SEND_LIMIT_CONFIG["global_rate"] / WORKERS
+    send_limiter.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+
+    async def report_ready():
+        await startup_ready.wait()
+        ready.value = 1
+
+    async def run():
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+        reporter = asyncio.create_task(report_ready())
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        try:
+            await feed_worker_updates(updates)
+        finally:
+            reporter.cancel()
+            await dp.emit_shutdown(bot=bot, dispatcher=dp)
+
+    asyncio.run(run())
+    logger.info("Воркер %s остановлен", index)
+
+async def poll_raw_updates(handle):
+    """Long polling без разбора обновлений: воркерам передаются исходные JSON-объекты"""
+    url = f"{TELEGRAM_API_URL or 'https://api.telegram.org'}/bot{BOT_TOKEN}/getUpdates"
+    params = {"timeout": 30, "allowed_updates": json.dumps(dp.resolve_used_update_types())}
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=40)) as session:
+        while True:
+            try:
+                async with session.get(url, params=params) as response:
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error("Ошибка получения обновлений: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not data.get("ok"):
+                logger.error("Telegram вернул ошибку getUpdates: %s", data.get('description'))
+                await asyncio.sleep(data.get("parameters", {}).get("retry_after", 1))
+                continue
+            for update in data["result"]:
+                if not await handle(update):
+                    # Обновление не принято: offset не сдвигается, Telegram вернет его при следующем запросе
+                    await asyncio.sleep(1)
+                    break
+                params["offset"] = update["update_id"] + 1
+
+def queue_size(updates: multiprocessing.Queue):
+    """Примерная длина очереди; на macOS qsize не поддерживается"""
+    try:
+        return updates.qsize()
+    except NotImplementedError:
+        return None
+
+async def run_supervisor():
+    """Прием обновлений и распределение по воркерам по chat_id.
+
+    Все обновления одного чата попадают в один воркер, поэтому их порядок
+    сохраняется, а разные чаты обрабатываются параллельно на разных ядрах.
+    Упавший воркер перезапускается с новой очередью: убитый процесс мог
+    оставить захваченной блокировку чтения старой. Обновления, которые уже
+    стояли в очереди упавшего воркера, теряются. Если воркер падает чаще
+    max_restarts раз за restart_window, бот останавливается.
+    """
+    context = multiprocessing.get_context("spawn")
+    # Каждому воркеру нужно еще одно соединение для LISTEN каталога
+    pool_size = max(2, DB_CONNECTION_BUDGET // WORKERS - 1)
+    queues = [None] * WORKERS
+    processes = [None] * WORKERS
+    ready_flags = [None] * WORKERS  # флаги готовности, которые выставляют сами воркеры
+    restarts = [deque() for _ in range(WORKERS)]  # время последних перезапусков каждого воркера
+
+    def spawn(index: int):
+        previous = queues[index]
+        if previous is not None:
+            # Не ждать при выходе, пока фоновый поток очереди допишет данные, которые никто не прочитает
+            previous.cancel_join_thread()
+            previous.close()
+        queues[index] = context.Queue(maxsize=WEBHOOK_CONFIG["max_in_flight"])
+        ready_flags[index] = context.Value("b", 0, lock=False)
+        processes[index] = context.Process(
+            target=worker_main, args=(index, queues[index], pool_size, ready_flags[index]),
+            name=f"bot-worker-{index}"
+        )
+        processes[index].start()
+
+    def workers_state() -> tuple:
+        """Основной процесс готов, когда готовы все воркеры"""
+        ready = [process.is_alive() and bool(flag.value) for process, flag in zip(processes, ready_flags)]
+        return all(ready), {"workers": ready}
+
+    for index in range(WORKERS):
+        spawn(index)
+    if PROBE_CONFIG is not None:
+        await start_probe_server(workers_state)
+    ring = HashRing(WORKERS)
+    logger.info("Запущено воркеров: %s, пул каждого до %s соединений", WORKERS, pool_size)
+
+    async def watch_workers():
+        while True:
+            await asyncio.sleep(WORKER_SUPERVISION["check_interval"])
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                now = time.monotonic()
+                recent = restarts[index]
+                while recent and now - recent[0] > WORKER_SUPERVISION["restart_window"]:
+                    recent.popleft()
+                if len(recent) >= WORKER_SUPERVISION["max_restarts"]:
+                    raise RuntimeError(f"воркер {index} постоянно падает (код {process.exitcode})")
+                recent.append(now)
+                logger.error(
+                    "Воркер %s завершился с кодом %s, перезапускаем; необработанных в его очереди: ~%s",
+                    index, process.exitcode, queue_size(queues[index])
+                )
+                spawn(index)
+
+    def accept(update: dict) -> bool:
+        index = ring.get(update_chat_id(update))
+        # Пока воркер перезапускается, Telegram получит 503 и повторит доставку
+        if not processes[index].is_alive():
+            return False
+        try:
+            queues[index].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    async def put(update: dict) -> bool:
+        index = ring.get(update_chat_id(update))
+        try:
+            await asyncio.to_thread(queues[index].put, update, True, WORKER_SUPERVISION["put_timeout"])
+        except (queue.Full, ValueError):
+            # ValueError: пока ждали места, воркер упал и его очередь закрыта при перезапуске
+            logger.warning("Очередь воркера %s заполнена, обновления будут получены повторно", index)
+            return False
+        return True
+
+    runner = None
+
+    async def receive():
+        nonlocal runner
+        if UPDATES_MODE == "webhook":
+            runner = await start_webhook_server(create_webhook_app(accept))
+            await asyncio.Event().wait()
+        else:
+            await bot.delete_webhook()
+            await poll_raw_updates(put)
+
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(watch_workers())]
+    try:
+        # Работаем до ручной остановки или до ошибки приема обновлений и наблюдения за воркерами
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if runner is not None:
+            await runner.cleanup()
+        if probe_runner is not None:
+            await probe_runner.cleanup()
+        for updates, process in zip(queues, processes):
+            if not process.is_alive():
+                continue
+            try:
+                await asyncio.to_thread(updates.put, None, True, WORKER_SUPERVISION["put_timeout"])
+            except queue.Full:
+                logger.error("Воркер %s не разбирает очередь, завершаем принудительно", process.name)
+                process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+        await bot.session.close()
+
 async def main():
+    if WORKERS > 1:
+        await run_supervisor()
+        return
+
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
-    await dp.start_polling(bot)
+    if UPDATES_MODE == "webhook":
+        await run_webhook()
+    else:
+        # Long polling не работает, пока у бота установлен webhook
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    import asyncio
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):